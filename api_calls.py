@@ -3,11 +3,12 @@ from typing import List, Dict, Union, Any
 import pandas as pd
 from st_aggrid import AgGridReturn, GridOptionsBuilder, AgGrid, GridUpdateMode
 
-import requests
 import random
-import json
 
+from api_client import api_get, api_post
 from db_connection import DB_CONNECTION
+from reference_cache import cached_reference, invalidate_reference_data
+from table_search import search_table, invalidate_table
 
 from payloads import Player_payload_non_forecast, Insert_dvs_eval_payload, Insert_dvs_eval_rom, Insert_dvs_score, \
     DVS_trainer, DVS_facility, DVS_organization, DVS_team, Player_payload_forecast
@@ -31,11 +32,7 @@ def get_db_status(db_name: str) -> str:
     Get the status of connection to the DB.
     If a connection cannot be made, raises a DBCONNECTException
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/get_db_status?db_name={db_name}"
-
-    payload = {}
-    headers = {}
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get("get_db_status", params={'db_name': db_name})
 
     if response.status_code == 200:
         return response.text
@@ -44,45 +41,35 @@ def get_db_status(db_name: str) -> str:
                                  f"Please contact admin.")
 
 
+@cached_reference('trainers')
 def get_trainer_dict(db_name: str) -> Dict[int, str]:
     """
     Get all the trainers list based on db_name
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/trainer_list/{db_name}"
-
-    headers = {
-        'access_token': 'dv$2022'
-    }
-    payload = {}
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"trainer_list/{db_name}")
     result = {int(i['dvs_trainer_id']): f"{i['trainer_firstname']} {i['trainer_lastname']}" for i in response.json()}
     result[-1] = ""
     result[-2] = None
     return result
 
 
+@cached_reference('facilities')
 def get_facility_dict(db_name: str) -> Dict[int, str]:
     """
     Get all the facility names list based on the db_name
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/facility_list/{db_name}"
-
-    payload = {}
-    headers = {
-        'access_token': 'dv$2022'
-    }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"facility_list/{db_name}")
     result = {int(i['dvs_facility_id']): f"{i['facility_name']}" for i in response.json()}
     result[-1] = ""
     result[-2] = None
     return result
 
 
+@cached_reference('teams')
 def get_team_dict(db_name: str) -> Dict[int, str]:
     """
     Get all the team names and team ids
@@ -98,31 +85,19 @@ def get_team_dict(db_name: str) -> Dict[int, str]:
         result.update({index: value for index, value in enumerate(MLB_TEAMS)})
         return result
     else:
-        url = f"https://deliveryvaluesystemapidev.azurewebsites.net/team_list/{db_name}"
-
-        payload = {}
-        headers = {
-            'access_token': 'dv$2022'
-        }
-        response = requests.request("GET", url, headers=headers, data=payload)
+        response = api_get(f"team_list/{db_name}")
         result.update({int(i['team_id']): f"{i['team_name']}" for i in response.json()})
         return result
 
 
+@cached_reference('orgs')
 def get_org_dict(db_name: str) -> Dict[int, str]:
     """
     Get all the team names and team ids
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/org_list/{db_name}"
-
-    payload = {}
-    headers = {
-        'access_token': 'dv$2022'
-    }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"org_list/{db_name}")
 
     result = {int(i['org_id']): f"{i['org_name']}" for i in response.json()}
     result[-1] = ""
@@ -132,36 +107,26 @@ def get_org_dict(db_name: str) -> Dict[int, str]:
     return result
 
 
+@cached_reference('analysts')
 def get_analyst_dict(db_name: str) -> Dict[int, str]:
     """
     Based on db_name return unique analyst names and ids
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/analyst_names/{db_name}"
-
-    payload = {}
-    headers = {}
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"analyst_names/{db_name}")
 
     return {int(i['dvs_analyst_id']): f"{i['analyst_name']}" for i in response.json()}
 
 
+@cached_reference('workouts')
 def get_workout_list(db_name: str) -> List[str]:
     """
     Get workout names list based on db name
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/workout_names_list/{db_name}"
-
-    payload = {}
-    headers = {
-        'access_token': 'dv$2022'
-    }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"workout_names_list/{db_name}")
 
     return [i['workout_name'] for i in response.json()]
 
@@ -183,29 +148,28 @@ def convert_to_aggrid(df: pd.DataFrame, key_: str) -> AgGridReturn:
                   key=key_)
 
 
-def get_table(url: str, search_string: str, sort_column: str) -> pd.DataFrame:
+def table_path(table: str, db_name: str) -> str:
     """
-    get a select all table based on the url
-    :param search_string:
-    :param url:
-    :param sort_column:
+    API path of a select all table
+    :param table: client, player, trainer, facility, org or team
+    :param db_name:
     :return:
     """
-    payload = {}
-    headers = {}
+    if table in ('client', 'player'):
+        return f"dvs_{table}_table/{db_name}"
+    return f"tables/dvs_{table}_table/{db_name}"
 
-    response = requests.request("GET", url, headers=headers, data=payload).json()
-
-    df = pd.DataFrame.from_records(response)
 
-    # Filter based on last_name_search
-    filter_0 = df[sort_column].apply(lambda x: x.lower()) == search_string.lower()
-
-    df = df.where(filter_0) \
-        .sort_values([sort_column]) \
-        .dropna(axis=0, how='all')
-
-    return df
+def get_table(path: str, search_string: str, sort_column: str, page: int = 0) -> pd.DataFrame:
+    """
+    get the rows of a table based on the API path whose sort_column matches search_string, one page at a time
+    :param search_string:
+    :param path:
+    :param sort_column:
+    :param page:
+    :return:
+    """
+    return search_table(path, sort_column, search_string, page)
 
 
 def get_dvs_client_table(db_name: str, last_name_search: str, key_: str) -> AgGridReturn:
@@ -214,8 +178,7 @@ def get_dvs_client_table(db_name: str, last_name_search: str, key_: str) -> AgGr
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/dvs_client_table/{db_name}"
-    df = get_table(url, last_name_search, 'client_lastname')
+    df = get_table(table_path('client', db_name), last_name_search, 'client_lastname')
     return convert_to_aggrid(df, key_)
 
 
@@ -226,8 +189,7 @@ def get_dvs_player_table(db_name: str, last_name_search: str, key_: str) -> AgGr
     :param key_:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/dvs_player_table/{db_name}"
-    df = get_table(url, last_name_search, 'last_name')
+    df = get_table(table_path('player', db_name), last_name_search, 'last_name')
     return convert_to_aggrid(df, key_)
 
 
@@ -238,8 +200,7 @@ def get_dvs_trainer_table(db_name: str, last_name_search: str, key_: str) -> AgG
     :param key_:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/tables/dvs_trainer_table/{db_name}"
-    df = get_table(url, last_name_search, 'trainer_lastname')
+    df = get_table(table_path('trainer', db_name), last_name_search, 'trainer_lastname')
     return convert_to_aggrid(df, key_)
 
 
@@ -250,8 +211,7 @@ def get_dvs_facility_table(db_name: str, last_name_search: str, key_: str) -> Ag
     :param key_:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/tables/dvs_facility_table/{db_name}"
-    df = get_table(url, last_name_search, 'facility_name')
+    df = get_table(table_path('facility', db_name), last_name_search, 'facility_name')
     return convert_to_aggrid(df, key_)
 
 
@@ -263,8 +223,7 @@ def get_dvs_org_table(db_name: str, last_name_search: str, key_: str) -> AgGridR
     :param key_:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/tables/dvs_org_table/{db_name}"
-    df = get_table(url, last_name_search, 'org_name')
+    df = get_table(table_path('org', db_name), last_name_search, 'org_name')
     return convert_to_aggrid(df, key_)
 
 
@@ -276,23 +235,18 @@ def get_dvs_team_table(db_name: str, last_name_search: str, key_: str) -> AgGrid
     :param key_:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/tables/dvs_team_table/{db_name}"
-    df = get_table(url, last_name_search, 'team_name')
+    df = get_table(table_path('team', db_name), last_name_search, 'team_name')
     return convert_to_aggrid(df, key_)
 
 
+@cached_reference('workout_ids')
 def get_workout_id_name_dict(db_name: str) -> Dict[int, str]:
     """
     Return a workout id name dict based on db_name
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/workout_id_dict/{db_name}"
-
-    payload = {}
-    headers = {}
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = api_get(f"workout_id_dict/{db_name}")
 
     return response.json()
 
@@ -305,12 +259,7 @@ def get_dvs_score(db_name: str, client_id: int, key_: str) -> AgGridReturn:
     :param client_id:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/dvs_scores/{db_name}/{client_id}"
-
-    payload = {}
-    headers = {}
-
-    response = requests.request("GET", url, headers=headers, data=payload).json()
+    response = api_get(f"dvs_scores/{db_name}/{client_id}").json()
 
     df = pd.DataFrame.from_records(response)
 
@@ -329,13 +278,7 @@ def check_duplicates(db_name: str, birthday: str, first_name: str, last_name: st
     :param last_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/check_dup_clients/{db_name}/" \
-          f"{birthday}/{first_name}/{last_name}"
-
-    payload = {}
-    headers = {}
-
-    response = requests.request("GET", url, headers=headers, data=payload).json()
+    response = api_get(f"check_dup_clients/{db_name}/{birthday}/{first_name}/{last_name}").json()
 
     if response == -1:
         return True
@@ -350,12 +293,7 @@ def generate_primary_key(pk: str, table_name: str, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/max_pk/{pk}/{table_name}/{db_name}"
-
-    payload = {}
-    headers = {}
-
-    response = requests.request("GET", url, headers=headers, data=payload).json()
+    response = api_get(f"max_pk/{pk}/{table_name}/{db_name}").json()
 
     if response == -1:
         return -1
@@ -372,13 +310,8 @@ def add_player_to_db(db_name: str, pk: int, payload: Player_payload_non_forecast
     :return:
     """
 
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/insert_into_dvs_client/{pk}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"insert_into_dvs_client/{pk}/{db_name}", payload)
+    invalidate_table(table_path('client', db_name))
 
     return response.status_code
 
@@ -391,12 +324,8 @@ def update_client_on_db(db_name: str, client_id: int, payload: Player_payload_no
     :param payload:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/update_dvs_client/{client_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"update_dvs_client/{client_id}/{db_name}", payload)
+    invalidate_table(table_path('client', db_name))
     return response.status_code
 
 
@@ -408,12 +337,8 @@ def update_player_on_db(db_name: str, player_id: int, payload: Player_payload_fo
     :param payload:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/edit/update_dvs_player/{player_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"edit/update_dvs_player/{player_id}/{db_name}", payload)
+    invalidate_table(table_path('player', db_name))
     return response.status_code
 
 
@@ -425,13 +350,7 @@ def add_eval_info_to_db(db_name: str, eval_id: int, payload: Insert_dvs_eval_pay
     :param payload:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_bio_performance_data/{eval_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_bio_performance_data/{eval_id}/{db_name}", payload)
 
     return response.status_code
 
@@ -444,13 +363,7 @@ def add_eval_rom_to_db(db_name: str, eval_id: int, payload: Insert_dvs_eval_rom)
     :param payload:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_dvs_eval_rom/{eval_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_dvs_eval_rom/{eval_id}/{db_name}", payload)
 
     return response.status_code
 
@@ -463,13 +376,7 @@ def add_dvs_score_to_db(db_name: str, score_id: int, payload: Insert_dvs_score):
     :param payload:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_dvs_score/{score_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_dvs_score/{score_id}/{db_name}", payload)
 
     return None
 
@@ -482,13 +389,7 @@ def check_trainer_exists(first_name: str, last_name: str, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/trainer_check/{first_name}/{last_name}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("GET", url, headers=headers)
+    response = api_get(f"trainer_check/{first_name}/{last_name}/{db_name}")
 
     return int(response.json())
 
@@ -501,13 +402,9 @@ def add_trainer_to_db(payload: DVS_trainer, trainer_id: int, db_name: str) -> in
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_trainer/{trainer_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_trainer/{trainer_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'trainers')
+    invalidate_table(table_path('trainer', db_name))
 
     return 1
 
@@ -520,13 +417,9 @@ def update_trainer_on_db(payload: DVS_trainer, trainer_id: int, db_name: str) ->
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/edit/update_dvs_trainer/{trainer_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"edit/update_dvs_trainer/{trainer_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'trainers')
+    invalidate_table(table_path('trainer', db_name))
 
     return response.status_code
 
@@ -538,13 +431,7 @@ def check_facility_exists(facility_name: str, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/facility_check/{facility_name}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("GET", url, headers=headers)
+    response = api_get(f"facility_check/{facility_name}/{db_name}")
 
     return int(response.json())
 
@@ -557,13 +444,9 @@ def add_facility_to_db(payload: DVS_facility, facility_id: int, db_name: str) ->
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_facility/{facility_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_facility/{facility_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'facilities')
+    invalidate_table(table_path('facility', db_name))
 
     return 1
 
@@ -576,13 +459,9 @@ def update_facility_on_db(payload: DVS_facility, facility_id: int, db_name: str)
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/edit/update_dvs_facility/{facility_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"edit/update_dvs_facility/{facility_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'facilities')
+    invalidate_table(table_path('facility', db_name))
 
     return response.status_code
 
@@ -594,13 +473,7 @@ def check_org_exists(org_name: str, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/org_check/{org_name}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("GET", url, headers=headers)
+    response = api_get(f"org_check/{org_name}/{db_name}")
 
     return int(response.json())
 
@@ -613,13 +486,9 @@ def add_org_to_db(payload: DVS_organization, org_id: int, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_org/{org_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_org/{org_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'orgs')
+    invalidate_table(table_path('org', db_name))
 
     return 1
 
@@ -632,11 +501,9 @@ def update_org_on_db(payload: DVS_organization, org_id: int, db_name: str) -> in
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/edit/update_dvs_org/{org_id}/{db_name}"
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"edit/update_dvs_org/{org_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'orgs')
+    invalidate_table(table_path('org', db_name))
 
     return response.status_code
 
@@ -649,11 +516,9 @@ def update_team_on_db(payload: DVS_team, team_id: int, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/edit/update_dvs_team/{team_id}/{db_name}"
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"edit/update_dvs_team/{team_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'teams')
+    invalidate_table(table_path('team', db_name))
 
     return response.status_code
 
@@ -665,13 +530,7 @@ def check_team_exists(team_name: str, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/team_check/{team_name}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("GET", url, headers=headers)
+    response = api_get(f"team_check/{team_name}/{db_name}")
 
     return int(response.json())
 
@@ -684,12 +543,8 @@ def add_team_to_db(payload: DVS_team, team_id: int, db_name: str) -> int:
     :param db_name:
     :return:
     """
-    url = f"https://deliveryvaluesystemapidev.azurewebsites.net/add_team/{team_id}/{db_name}"
-
-    headers = {
-        'Content-Type': 'application/json',
-    }
-
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload.__dict__))
+    response = api_post(f"add_team/{team_id}/{db_name}", payload)
+    invalidate_reference_data(db_name, 'teams')
+    invalidate_table(table_path('team', db_name))
 
     return 1
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# DVS API host and access token, overridable from the environment
+API_BASE_URL = os.environ.get('DVS_API_BASE_URL', 'https://deliveryvaluesystemapidev.azurewebsites.net')
+API_ACCESS_TOKEN = os.environ.get('DVS_API_ACCESS_TOKEN', 'dv$2022')
+
+# (connect, read) timeouts in seconds
+API_TIMEOUT = (5, 60)
+
+# Connections kept alive to the API host, shared by every Streamlit session of the app
+API_POOL_MAXSIZE = 16
+
+# Reads are retried with exponential backoff on connection errors and transient server errors. Writes are only retried
+# when the connection could not be made, so an insert is never sent twice
+API_RETRY = Retry(total=3, connect=3, read=2, status=3, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset({'GET'}),
+                  raise_on_status=False)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def create_session() -> requests.Session:
+    """
+    Session with a keep-alive connection pool to the API host, the default headers and the retry policy
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_MAXSIZE, max_retries=API_RETRY)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'access_token': API_ACCESS_TOKEN})
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Module level session, created on first use. Reusing it skips the TCP and TLS handshakes on every call
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def api_url(path: str) -> str:
+    return f"{API_BASE_URL}/{path.lstrip('/')}"
+
+
+def api_request(method: str, path: str, **kwargs) -> requests.Response:
+    """
+    Sends a request to an API path through the shared session, with the default timeout unless one is given
+    """
+    kwargs.setdefault('timeout', API_TIMEOUT)
+    return get_session().request(method, api_url(path), **kwargs)
+
+
+def api_get(path: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+    return api_request("GET", path, params=params)
+
+
+def api_post(path: str, payload: Any) -> requests.Response:
+    """
+    Posts a payload dataclass as json
+    """
+    return api_request("POST", path, headers={'Content-Type': 'application/json'},
+                       data=json.dumps(payload.__dict__))
@@ -1,8 +1,11 @@
-from typing import Dict, List, Optional
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
 
 from api_calls import get_db_status, DBCONNECTException, get_facility_dict, get_trainer_dict, get_team_dict, \
     get_org_dict
 from db_connection import DB_CONNECTION
+from reference_cache import REFERENCE_TTL_S, invalidate_reference_data, reference_version
 
 db_name_dict = {
     'DVS Analytics': DB_CONNECTION.FORECAST,
@@ -11,6 +14,14 @@ db_name_dict = {
     'DVS Dev'      : DB_CONNECTION.DEV
 }
 
+# Dictionaries filled by DB_setup and their lookup functions, by dictionary name
+dict_lookups = {
+    'team'        : get_team_dict,
+    'facility'    : get_facility_dict,
+    'trainer'     : get_trainer_dict,
+    'organization': get_org_dict
+}
+
 
 def reverse_dict(dict_: Dict[int, str]) -> Dict[str, int]:
     """
@@ -30,9 +41,6 @@ class DB_setup:
         self.db_name = db_name
         self.st_obj = st_obj
 
-        # Make a db connection
-        self.db_connection = self.connect_to_db()
-
         # Initialize dictionary setup
         self.facility_dict = {}
         self.trainer_dict = {}
@@ -40,33 +48,92 @@ class DB_setup:
         self.organization_dict = {}
         self.analyst_dict = {}
 
-        self.init_dicts()
+        self.reverse_facility_dict = {}
+        self.reverse_trainer_dict = {}
+        self.reverse_team_dict = {}
+        self.reverse_organization_dict = {}
+        self.reverse_analyst_dict = {}
+
+        # The db status check and the dictionary lookups are independent requests, they are sent at once so startup
+        # waits for the slowest one instead of their sum
+        db_name_enum = db_name_dict[self.db_name]
+        # Taken before the lookups, so an edit made while they run leaves this setup stale
+        self.reference_version = reference_version(db_name_enum.value)
+        self.created = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(dict_lookups) + 1) as executor:
+            db_status = executor.submit(get_db_status, db_name_enum.value)
+            lookups = {executor.submit(lookup, db_name_enum.value): name
+                       for name, lookup in self.dict_lookups(db_name_enum).items()}
+
+            # Make a db connection
+            self.db_connection = self.connect_to_db(db_status)
 
-        self.reverse_facility_dict = reverse_dict(self.facility_dict)
-        self.reverse_trainer_dict = reverse_dict(self.trainer_dict)
-        self.reverse_team_dict = reverse_dict(self.team_dict)
-        self.reverse_organization_dict = reverse_dict(self.organization_dict)
-        self.reverse_analyst_dict = reverse_dict(self.analyst_dict)
+            if self.db_connection is not None:
+                self.init_dicts(lookups)
 
-    def connect_to_db(self) -> Optional[DB_CONNECTION]:
+    def connect_to_db(self, db_status: Future) -> Optional[DB_CONNECTION]:
         """
         Based on the db name makes a connection to the respective databases
-        :param db_name:
+        :param db_status: pending get_db_status request
         :return:
         """
         db_name_enum = db_name_dict[self.db_name]
 
         try:
-            db_status = get_db_status(db_name_enum.value)
+            db_status.result()
             self.st_obj.success("Connection successful")
             return db_name_enum
         except DBCONNECTException:
             print(DBCONNECTException)
             self.st_obj("Cannot connect to db")
 
-    def init_dicts(self):
-        self.team_dict = get_team_dict(self.db_connection.value)
-        if self.db_connection != DB_CONNECTION.FORECAST:
-            self.facility_dict = get_facility_dict(self.db_connection.value)
-            self.trainer_dict = get_trainer_dict(self.db_connection.value)
-            self.organization_dict = get_org_dict(self.db_connection.value)
\ No newline at end of file
+    @staticmethod
+    def dict_lookups(db_connection: DB_CONNECTION) -> Dict[str, Callable[[str], Dict[int, str]]]:
+        """
+        Lookup functions of the dictionaries needed for db_connection, by dictionary name
+        :param db_connection:
+        :return:
+        """
+        if db_connection == DB_CONNECTION.FORECAST:
+            return {'team': dict_lookups['team']}
+        return dict_lookups
+
+    def init_dicts(self, lookups: Dict[Future, str]):
+        """
+        Fills the dictionaries and their reverse as the lookups complete
+        :param lookups: pending lookup requests and their dictionary names
+        :return:
+        """
+        for lookup in as_completed(lookups):
+            name = lookups[lookup]
+            setattr(self, f"{name}_dict", lookup.result())
+            setattr(self, f"reverse_{name}_dict", reverse_dict(getattr(self, f"{name}_dict")))
+
+    def is_stale(self) -> bool:
+        """
+        True when the connection failed, the reference data was edited since this setup was made or it is older than
+        the reference data TTL
+        :return:
+        """
+        return self.db_connection is None \
+            or reference_version(self.db_connection.value) != self.reference_version \
+            or time.monotonic() - self.created > REFERENCE_TTL_S
+
+
+def get_session_db_setup(db_name: str, st_obj, refresh: bool = False) -> DB_setup:
+    """
+    DB_setup of the Streamlit session, kept in session state across reruns. It is rebuilt when the selected db changes,
+    when it is stale or when refresh is requested, in which case the cached reference data is fetched again
+    :param db_name: sidebar db selection
+    :param st_obj: streamlit module
+    :param refresh:
+    :return:
+    """
+    if refresh:
+        invalidate_reference_data(db_name_dict[db_name].value)
+
+    db_setup = st_obj.session_state.get('db_setup')
+    if refresh or db_setup is None or db_setup.db_name != db_name or db_setup.is_stale():
+        db_setup = DB_setup(db_name, st_obj)
+        st_obj.session_state['db_setup'] = db_setup
+    return db_setup
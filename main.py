@@ -4,6 +4,7 @@ from datetime import datetime
 import os
 import sys
 import re
+import time
 import shutil
 import streamlit as st
 import pandas as pd
@@ -11,7 +12,7 @@ from st_aggrid import AgGrid, GridOptionsBuilder
 
 from db_connection import DB_CONNECTION
 
-from db_setup import DB_setup
+from db_setup import get_session_db_setup
 
 from payloads import Player_payload_non_forecast, Insert_dvs_eval_payload, Insert_dvs_eval_rom, Insert_dvs_score, \
     DVS_trainer, DVS_facility, DVS_organization, DVS_team, Player_payload_forecast
@@ -24,18 +25,21 @@ from api_calls import get_db_status, get_trainer_dict, get_facility_dict, get_te
     update_player_on_db, update_trainer_on_db, get_dvs_trainer_table, get_dvs_facility_table, update_facility_on_db, \
     get_dvs_org_table, update_org_on_db, get_dvs_team_table, update_team_on_db
 
-from msk.uploaded_video_file import UploadedFile, uploaded_videos_dir_name, upload_video, video_exists, get_video_bytes
+from msk.uploaded_video_file import get_video_bytes
+from msk.result_cache import ResultCache
+from msk.job_queue import JobQueue, job_done, job_failed
 
 # Sidebar selection
 add_selectbox = st.sidebar.selectbox(
         "Select DB: ",
         ("DVS Dev", "DVS Analytics", "DVS Training", "Mayo Clinic")
 )
+refresh_db_data = st.sidebar.button("Refresh data")
 
 db_connection_name = None
 db_init_setup = None
 if add_selectbox != 'None':
-    db_init_setup = DB_setup(add_selectbox, st)
+    db_init_setup = get_session_db_setup(add_selectbox, st, refresh=refresh_db_data)
     db_connection_name = db_init_setup.db_connection
 
 # Add tabs
@@ -1346,6 +1350,12 @@ with tab_report:
 
 
 # X-RAY tab
+@st.experimental_singleton
+def get_xray_job_queue() -> JobQueue:
+    # One job queue and worker pool for every session of the app
+    return JobQueue(ResultCache())
+
+
 def show_page():
     # Drag and drop video file - also write a call back function here that would generate a tracker csv as the video gets
     # uploaded
@@ -1358,29 +1368,47 @@ def show_page():
         bytes_data = raw_video_file.getvalue()
         st.video(bytes_data)
 
-        # Upload file
-        uploaded_video_file_path = os.path.join(uploaded_videos_dir_name, raw_video_file.name)
-        upload_video(bytes_data, uploaded_video_file_path)
-
-        # # Create Uploaded file object
-        uploaded_file = UploadedFile(uploaded_video_file_path)
+        # Processing runs in the background job queue. Jobs are keyed by video content and pipeline parameters, so
+        # another session uploading the same video joins the same job. The job of an uploaded file is remembered for
+        # the session, reruns of the page poll it without writing and hashing the upload again
+        job_queue = get_xray_job_queue()
+        xray_jobs = st.session_state.setdefault('xray_jobs', {})
+        upload_key = f"{raw_video_file.id}-{raw_video_file.name}"
+        if upload_key not in xray_jobs:
+            # Upload file
+            job_id, digest = job_queue.submit_upload(bytes_data, raw_video_file.name)
+            xray_jobs[upload_key] = {'job_id': job_id, 'digest': digest}
+        job_id = xray_jobs[upload_key]['job_id']
 
         st.markdown('## MSK overlay')
 
-        filtered_video_path = os.path.join("filtered_mks",
-                                           f"{raw_video_file.name.split('.')[0]}_joint_tracker_filtered.mp4")
-
-        with st.spinner("Processing video in the background (This may take a few mins)..."):
-
-            st.write(filtered_video_path)
-
-            if not video_exists(filtered_video_path):
-                filtered_video_path = uploaded_file.process_video()
-            else:
-                print(f"Filtered video for this file already exists - {filtered_video_path}")
-
-            print(filtered_video_path)
-            st.video(get_video_bytes(filtered_video_path))
+        # Poll the job, the work carries on in the background if the page is rerun in the meantime
+        progress_bar = st.progress(0.0)
+        preview_placeholder = st.empty()
+        job = job_queue.status(job_id)
+        while job['status'] not in (job_done, job_failed):
+            progress_bar.progress(job['progress'])
+            preview_path = job_queue.preview_path(job_id)
+            if os.path.exists(preview_path):
+                preview_placeholder.image(preview_path, caption=f"Live preview - {job['status']}")
+            time.sleep(1)
+            job = job_queue.status(job_id)
+        progress_bar.empty()
+        preview_placeholder.empty()
+
+        artifact_paths = job_queue.result(job_id)
+        if job['status'] == job_failed or artifact_paths is None:
+            st.error(f"Video processing failed: {job['error'] or 'the outputs are no longer cached'}")
+            # Failed jobs are not run again on their own, every rerun of the app would restart them
+            if st.button("Retry processing", key=f"retry_{job_id}"):
+                job_queue.submit_upload(bytes_data, raw_video_file.name, retry=True,
+                                        digest=xray_jobs[upload_key]['digest'])
+                st.experimental_rerun()
+            return
+
+        filtered_video_path = artifact_paths['filtered_video']
+        st.write(filtered_video_path)
+        st.video(get_video_bytes(filtered_video_path))
 
         st.success("File processing is done!")
 
@@ -0,0 +1,172 @@
+"""
+Batch X-RAY processing of session videos. Run with: python -m msk.batch <directory or glob> [options]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+from msk.filtering import default_cutoff_hz, filter_strategies
+from msk.pose_pool import default_draft_motion_budget, default_inference_max_side
+from msk.result_cache import ResultCache, cache_key, digest_file, result_cache_dir_name
+from msk.tracker_io import read_tracker_metadata
+from msk.uploaded_video_file import UploadedFile, mediapose_mks_dir_name, filtered_mks_dir_name
+
+batch_dir_name = 'xray_batch'
+batch_manifest_file_name = 'batch_manifest.json'
+video_extensions = ('.mp4', '.mov')
+# Directories written by the pipeline, never searched for input videos
+output_dir_names = (batch_dir_name, result_cache_dir_name, mediapose_mks_dir_name, filtered_mks_dir_name)
+
+
+def find_videos(source: str, recursive: bool = False) -> List[str]:
+    """
+    Video files of a directory, or matching a glob pattern, sorted by path. Pipeline output directories are skipped
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '**', '*') if recursive else os.path.join(source, '*')
+    return sorted(path for path in glob.glob(source, recursive=recursive)
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in video_extensions
+                  and not set(os.path.normpath(path).split(os.sep)) & set(output_dir_names))
+
+
+def _process_clip(video_path: str, options: Dict) -> Tuple[Dict[str, str], float]:
+    # Runs in a worker process, returns the artifact paths and the processing time in seconds
+    start = time.perf_counter()
+    uploaded_file = UploadedFile(video_path, **options)
+    uploaded_file.run_pipeline()
+    return {
+        'tracker': uploaded_file.tracker_path,
+        'annotated_video': uploaded_file.annotated_video_path,
+        'filtered_video': uploaded_file.filt_video_path
+    }, time.perf_counter() - start
+
+
+def clip_summary(video_path: str, key: str, status: str, artifact_paths: Optional[Dict[str, str]] = None,
+                 seconds: Optional[float] = None, error: Optional[str] = None) -> Dict:
+    summary = {'video': video_path, 'cache_key': key, 'status': status, 'seconds': seconds, 'error': error,
+               'artifacts': artifact_paths}
+    if artifact_paths is not None:
+        metadata = read_tracker_metadata(artifact_paths['tracker'])
+        summary['frames'] = metadata.get('frames')
+        if seconds and metadata.get('frames'):
+            summary['frames_per_second'] = metadata['frames'] / seconds
+    return summary
+
+
+def process_batch(video_paths: List[str], result_cache: ResultCache, workers: int = 1,
+                  batch_dir: str = batch_dir_name, **options) -> Dict:
+    """
+    Processes video_paths on a pool of worker processes, skipping the videos already in result_cache. Videos with the
+    same content are processed once. Artifacts are moved into result_cache as each video finishes
+    :param options: UploadedFile pipeline options, for instance cutoff_hz or draft_stride
+    :return: summary manifest with the status, timing and artifact paths of every video
+    """
+    batch_start = time.perf_counter()
+    inputs_dir = os.path.join(batch_dir, 'inputs')
+    os.makedirs(inputs_dir, exist_ok=True)
+
+    clips = []
+    keys: Dict[str, List[str]] = {}
+    for video_path in video_paths:
+        uploaded_file = UploadedFile(video_path, **options)
+        key = cache_key(digest_file(video_path), uploaded_file.pipeline_params())
+        keys.setdefault(key, []).append(video_path)
+
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for key, paths in keys.items():
+            artifact_paths = result_cache.get(key)
+            if artifact_paths is not None:
+                clips.extend(clip_summary(path, key, 'cached', artifact_paths) for path in paths)
+                print(f"Cached - {paths[0]}")
+                continue
+
+            # Outputs are named after the input file, a copy named by the cache key keeps them apart for clips with
+            # the same file name in different directories
+            input_path = os.path.join(inputs_dir, key + os.path.splitext(paths[0])[1])
+            shutil.copyfile(paths[0], input_path)
+            pending[executor.submit(_process_clip, input_path, options)] = (key, paths, input_path)
+
+        for future in as_completed(pending):
+            key, paths, input_path = pending[future]
+            try:
+                produced_paths, seconds = future.result()
+                artifact_paths = result_cache.put(key, produced_paths, source_name=os.path.basename(paths[0]),
+                                                  pipeline_params=UploadedFile(input_path, **options).pipeline_params())
+                clips.extend(clip_summary(path, key, 'processed', artifact_paths, seconds) for path in paths)
+                print(f"Processed in {seconds:.1f}s - {paths[0]}")
+            except Exception as e:
+                clips.extend(clip_summary(path, key, 'failed', error=f"{type(e).__name__}: {e}") for path in paths)
+                print(f"Failed - {paths[0]}: {e}")
+            finally:
+                os.remove(input_path)
+
+    clips.sort(key=lambda clip: clip['video'])
+    return {
+        'options': options,
+        'workers': workers,
+        'seconds': time.perf_counter() - batch_start,
+        'processed': sum(clip['status'] == 'processed' for clip in clips),
+        'cached': sum(clip['status'] == 'cached' for clip in clips),
+        'failed': sum(clip['status'] == 'failed' for clip in clips),
+        'clips': clips
+    }
+
+
+def positive_float(value: str) -> float:
+    # argparse type of the overlay timing options
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def main(argv: Optional[List[str]] = None) -> Dict:
+    parser = argparse.ArgumentParser(description="Batch X-RAY processing of a directory or glob of mp4/mov videos")
+    parser.add_argument('source', help="directory of videos or glob pattern, quoted so the shell does not expand it")
+    parser.add_argument('--recursive', action='store_true', help="include videos in sub directories")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="videos processed at once (default: half the cores)")
+    parser.add_argument('--manifest', default=os.path.join(batch_dir_name, batch_manifest_file_name),
+                        help="path of the summary manifest")
+    parser.add_argument('--cutoff-hz', type=float, default=default_cutoff_hz)
+    parser.add_argument('--filter-strategy', choices=filter_strategies, default='low_pass')
+    parser.add_argument('--keep-outliers', action='store_true', help="do not reject outliers before filtering")
+    parser.add_argument('--inference-max-side', type=int, default=None,
+                        help=f"longest side of the frames inference runs on, suggested {default_inference_max_side}")
+    parser.add_argument('--roi-tracking', action='store_true')
+    parser.add_argument('--draft-stride', type=int, default=1)
+    parser.add_argument('--draft-motion-budget', type=float, default=None,
+                        help=f"adaptive draft mode joint motion per inference, suggested {default_draft_motion_budget}")
+    parser.add_argument('--output-fps', type=positive_float, default=None,
+                        help="frame rate of the overlay videos, frames are dropped below the source frame rate")
+    parser.add_argument('--slow-motion', type=positive_float, default=1.0, help="overlay playback slow down factor")
+    args = parser.parse_args(argv)
+
+    video_paths = find_videos(args.source, args.recursive)
+    print(f"{len(video_paths)} videos found in {args.source}")
+
+    manifest = process_batch(video_paths, ResultCache(), args.workers,
+                             cutoff_hz=args.cutoff_hz, filter_strategy=args.filter_strategy,
+                             reject_outliers=not args.keep_outliers, inference_max_side=args.inference_max_side,
+                             roi_tracking=args.roi_tracking, draft_stride=args.draft_stride,
+                             draft_motion_budget=args.draft_motion_budget, output_fps=args.output_fps,
+                             slow_motion=args.slow_motion)
+
+    os.makedirs(os.path.dirname(args.manifest) or '.', exist_ok=True)
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"{manifest['processed']} processed, {manifest['cached']} cached, {manifest['failed']} failed in "
+          f"{manifest['seconds']:.1f}s - manifest {args.manifest}")
+
+    return manifest
+
+
+if __name__ == '__main__':
+    main()
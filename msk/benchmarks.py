@@ -0,0 +1,320 @@
+"""
+Micro-benchmarks for the X-RAY pipeline hot spots. Run with: python -m msk.benchmarks
+"""
+import sys
+import time
+import timeit
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmarkList
+from scipy.signal import butter, sosfiltfilt
+
+from msk.filtering import filter_signals, lowess_filter_matrix, outlier_filter_matrix
+from msk.jointlandmarks import JointLandMarks, LandmarkStore, joint_names, joint_names_xyz_list
+from msk.mks_plotter import POSE_CONNECTIONS, draw_filtered_connections, joints_pixel_array, pose_settings, \
+    store_pose_landmarks
+from msk.pose_pool import default_draft_motion_budget, default_inference_max_side, read_frames, serial_pose_landmarks, \
+    draft_pose_landmarks
+
+
+def make_pose_landmarks(seed: int = 0) -> NormalizedLandmarkList:
+    rng = np.random.default_rng(seed)
+    pose_landmarks = NormalizedLandmarkList()
+    for x, y, z, visibility in rng.random((len(joint_names), 4)):
+        pose_landmarks.landmark.add(x=x, y=y, z=z, visibility=visibility)
+    return pose_landmarks
+
+
+def list_fields_reader(pose_landmarks: NormalizedLandmarkList, width: float, height: float) -> List[List[float]]:
+    # Landmark reading before get_joint_array - three reflective ListFields() calls per landmark
+    ele_list = pose_landmarks.ListFields()[0][1]
+    return [[ele.ListFields()[0][1] * width, ele.ListFields()[1][1] * height, ele.ListFields()[2][1]]
+            for ele in ele_list]
+
+
+def benchmark_landmark_reader(frames: int = 2000, width: int = 1920, height: int = 1080) -> Dict[str, float]:
+    """
+    Per frame cost in microseconds of reading the 33 landmarks of a pose into pixel coordinates
+    """
+    pose_landmarks = make_pose_landmarks()
+
+    np.testing.assert_allclose(JointLandMarks(pose_landmarks.landmark, width, height).get_joint_array()[:, :3],
+                               list_fields_reader(pose_landmarks, width, height), rtol=1e-6)
+
+    list_fields_s = min(timeit.repeat(lambda: list_fields_reader(pose_landmarks, width, height),
+                                      number=frames, repeat=5))
+    joint_array_s = min(timeit.repeat(
+            lambda: JointLandMarks(pose_landmarks.landmark, width, height).get_joint_array(),
+            number=frames, repeat=5))
+
+    return {
+        'list_fields_us': list_fields_s / frames * 1e6,
+        'joint_array_us': joint_array_s / frames * 1e6,
+        'speedup': list_fields_s / joint_array_s
+    }
+
+
+def per_column_filter(x: pd.Series) -> np.ndarray:
+    # Filtering before filter_signals - filter redesigned and applied once per column through df.transform
+    return sosfiltfilt(butter(2, 1/15, output='sos'), x)
+
+
+def make_tracker_df(frames: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    signals = np.cumsum(rng.normal(size=(frames, len(joint_names_xyz_list))), axis=0) + 500
+    return pd.DataFrame(signals, columns=joint_names_xyz_list)
+
+
+def benchmark_matrix_filter(frames: int = 120 * 120) -> Dict[str, float]:
+    """
+    Cost in milliseconds of filtering every tracker signal of a clip (default 2 minutes at 120 fps)
+    """
+    df = make_tracker_df(frames)
+
+    np.testing.assert_allclose(filter_signals(df.to_numpy(), reject_outliers=False),
+                               df.transform(per_column_filter).to_numpy(), rtol=1e-9, atol=1e-9)
+
+    per_column_s = min(timeit.repeat(lambda: df.transform(per_column_filter), number=1, repeat=5))
+    matrix_s = min(timeit.repeat(lambda: filter_signals(df.to_numpy(), reject_outliers=False), number=1, repeat=5))
+
+    return {
+        'per_column_ms': per_column_s * 1e3,
+        'matrix_ms': matrix_s * 1e3,
+        'speedup': per_column_s / matrix_s
+    }
+
+
+def benchmark_lowess(frames: int = 60 * 120) -> Dict[str, float]:
+    """
+    Cost in milliseconds of LOWESS smoothing every tracker signal of a clip (default 1 minute at 120 fps)
+    """
+    import statsmodels.api as sm
+
+    df = make_tracker_df(frames)
+    frame_numbers = np.arange(frames)
+
+    def statsmodels_lowess():
+        return df.transform(lambda x: sm.nonparametric.lowess(x, frame_numbers, frac=0.08)[:, 1])
+
+    np.testing.assert_allclose(lowess_filter_matrix(df.to_numpy()), statsmodels_lowess().to_numpy(), rtol=1e-6,
+                               atol=1e-6)
+
+    statsmodels_s = min(timeit.repeat(statsmodels_lowess, number=1, repeat=1))
+    matrix_s = min(timeit.repeat(lambda: lowess_filter_matrix(df.to_numpy()), number=1, repeat=3))
+
+    return {
+        'statsmodels_ms': statsmodels_s * 1e3,
+        'matrix_ms': matrix_s * 1e3,
+        'speedup': statsmodels_s / matrix_s
+    }
+
+
+def check_lowess_equivalence(lengths=range(3, 201), signals: int = 4) -> int:
+    """
+    Checks lowess_filter_matrix against statsmodels lowess on random walks of every length in lengths, short clips
+    with only a few frames per local fit included. Steps are Gaussian: on integer valued walks, the statsmodels
+    robustness weights of clips with 4 or 5 frame fits are set by round-off residuals
+    :return: number of clip lengths checked
+    """
+    import statsmodels.api as sm
+
+    for n in lengths:
+        x = np.cumsum(np.random.default_rng(n).normal(size=(n, signals)), axis=0)
+        expected = np.column_stack([sm.nonparametric.lowess(column, np.arange(n), frac=0.08)[:, 1] for column in x.T])
+        np.testing.assert_allclose(lowess_filter_matrix(x), expected, rtol=1e-6, atol=1e-6,
+                                   err_msg=f"LOWESS differs from statsmodels on {n} frames")
+    return len(lengths)
+
+
+def per_column_outlier_filter(x: pd.Series, quantile: float = 0.99) -> np.ndarray:
+    # Outlier removal before outlier_filter_matrix - 99th percentile of the jumps, forward filled, one column at a time
+    ser = x.dropna()
+    diff_abs_ser = ser.diff().abs()
+    ser[diff_abs_ser >= diff_abs_ser.quantile(quantile)] = None
+    return ser.ffill().to_numpy()
+
+
+def benchmark_outlier_filter(frames: int = 120 * 120) -> Dict[str, float]:
+    """
+    Cost in milliseconds of outlier removal over every tracker signal of a clip (default 2 minutes at 120 fps)
+    """
+    df = make_tracker_df(frames)
+
+    per_column_s = min(timeit.repeat(lambda: df.transform(per_column_outlier_filter), number=1, repeat=3))
+    matrix_s = min(timeit.repeat(lambda: outlier_filter_matrix(df.to_numpy()), number=1, repeat=3))
+
+    return {
+        'per_column_ms': per_column_s * 1e3,
+        'matrix_ms': matrix_s * 1e3,
+        'speedup': per_column_s / matrix_s
+    }
+
+
+def series_connections_drawer(image: np.ndarray, joints_frame: pd.Series) -> None:
+    # Overlay drawing before joints_pixel_array - two column lookups per joint and two markers per segment
+    def joint_xy(joint_number):
+        joint_name = joint_names[joint_number]
+        return int(joints_frame[f"{joint_name}_x_filt"]), int(joints_frame[f"{joint_name}_y_filt"])
+
+    for pair in POSE_CONNECTIONS:
+        p1, p2 = joint_xy(pair[0]), joint_xy(pair[1])
+        cv2.drawMarker(image, p1, (0, 0, 255), markerType=cv2.MARKER_STAR, markerSize=5, thickness=2)
+        cv2.drawMarker(image, p2, (0, 0, 255), markerType=cv2.MARKER_STAR, markerSize=5, thickness=2)
+        cv2.line(image, p1, p2, (50, 205, 50), thickness=2, lineType=cv2.LINE_4)
+
+
+def benchmark_overlay_rendering(frames: int = 600, width: int = 1920, height: int = 1080) -> Dict[str, float]:
+    """
+    Per frame cost in microseconds of drawing the filtered skeleton on a frame, including the per frame joint lookup
+    """
+    rng = np.random.default_rng(0)
+    # Skeleton spread over a quarter of the width and half of the height, like a person in frame
+    joints = rng.random((frames, len(joint_names), 3)) * [width / 4, height / 2, 1] + [3 * width / 8, height / 4, 0]
+    filtered_df = pd.DataFrame(joints.reshape(frames, -1),
+                               columns=[f"{col_name}_filt" for col_name in joint_names_xyz_list])
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def series_overlay():
+        for frame in range(frames):
+            series_connections_drawer(image, filtered_df.iloc[frame, :])
+
+    def pixel_array_overlay():
+        joints_px = joints_pixel_array(joints)
+        for frame in range(frames):
+            draw_filtered_connections(image, joints_px[frame])
+
+    series_s = min(timeit.repeat(series_overlay, number=1, repeat=3))
+    pixel_array_s = min(timeit.repeat(pixel_array_overlay, number=1, repeat=3))
+
+    return {
+        'series_us': series_s / frames * 1e6,
+        'pixel_array_us': pixel_array_s / frames * 1e6,
+        'speedup': series_s / pixel_array_s
+    }
+
+
+def visible_joints(visibility: np.ndarray, present: np.ndarray, threshold: float = 0.9) -> np.ndarray:
+    """
+    Joints (33,) with a median visibility above threshold over the frames with a pose. The other joints are mostly out
+    of frame or hidden, their positions are guessed by the model and their error says little about the mode measured
+    """
+    if not present.any():
+        return np.zeros(visibility.shape[1], dtype=bool)
+    return np.median(visibility[present], axis=0) > threshold
+
+
+def timed_pose_joints(images: List[np.ndarray], max_side: Optional[int] = None) \
+        -> Tuple[float, np.ndarray, np.ndarray]:
+    # Frames per second of pose inference, the joint pixel coordinates (frames, joints, 2), NaN where no pose, and the
+    # joint visibility (frames, joints)
+    height, width = images[0].shape[:2]
+    joints = np.full((len(images), len(joint_names), 2), np.nan)
+    visibility = np.zeros((len(images), len(joint_names)))
+
+    start = time.perf_counter()
+    for frame, _, pose_landmarks in serial_pose_landmarks(enumerate(images), pose_settings, max_side):
+        if pose_landmarks:
+            joint_array = JointLandMarks(pose_landmarks.landmark, width, height).get_joint_array()
+            joints[frame], visibility[frame] = joint_array[:, :2], joint_array[:, 3]
+    return len(images) / (time.perf_counter() - start), joints, visibility
+
+
+def benchmark_inference_resolution(video_path: str, max_side: int = default_inference_max_side, frames: int = 60,
+                                   sources: Tuple = ((1280, 720), (1920, 1080), (3840, 2160))) -> Dict[str, Dict]:
+    """
+    Pose inference fps at full resolution and downscaled to max_side, and the deviation in full resolution pixels of
+    the downscaled landmarks, for the first frames of video_path resized to every source resolution. The visible
+    deviation is over the joints visible at full resolution only, see visible_joints
+    """
+    cap = cv2.VideoCapture(video_path)
+    clip = [image for _, image in islice(read_frames(cap), frames)]
+    cap.release()
+
+    results = {}
+    for width, height in sources:
+        images = [cv2.resize(image, (width, height), interpolation=cv2.INTER_CUBIC) for image in clip]
+        full_fps, full_joints, full_visibility = timed_pose_joints(images)
+        downscaled_fps, downscaled_joints, _ = timed_pose_joints(images, max_side)
+
+        deviation = np.linalg.norm(downscaled_joints - full_joints, axis=-1)
+        both_detected = ~np.isnan(deviation).any(axis=1)
+        deviation = deviation[both_detected]
+        visible_deviation = deviation[:, visible_joints(full_visibility, both_detected)]
+        results[f"{height}p"] = {
+            'full_fps': full_fps,
+            'downscaled_fps': downscaled_fps,
+            'speedup': downscaled_fps / full_fps,
+            'detected_frames': int(both_detected.sum()),
+            'mean_deviation_px': float(deviation.mean()) if deviation.size else float('nan'),
+            'max_deviation_px': float(deviation.max()) if deviation.size else float('nan'),
+            'mean_visible_deviation_px': float(visible_deviation.mean()) if visible_deviation.size else float('nan')
+        }
+    return results
+
+
+def timed_landmark_store(video_path: str, stride: int = 1, motion_budget: Optional[float] = None) \
+        -> Tuple[float, int, LandmarkStore]:
+    # Seconds spent decoding and inferring video_path in draft mode, the number of inferred frames and the landmarks
+    cap = cv2.VideoCapture(video_path)
+    landmark_store = LandmarkStore(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), fps=cap.get(cv2.CAP_PROP_FPS),
+                                   width=int(cap.get(3)), height=int(cap.get(4)))
+
+    start = time.perf_counter()
+    inferred_frames = 0
+    last_pose_frame = None
+    for frame, _, pose_landmarks, inferred in draft_pose_landmarks(read_frames(cap), pose_settings, stride,
+                                                                   motion_budget):
+        inferred_frames = inferred_frames + inferred
+        last_pose_frame = store_pose_landmarks(landmark_store, frame, pose_landmarks, inferred, last_pose_frame)
+    cap.release()
+
+    return time.perf_counter() - start, inferred_frames, landmark_store
+
+
+def benchmark_draft_mode(video_path: str, strides: Tuple = (2, 4, 8),
+                         motion_budgets: Tuple = (default_draft_motion_budget / 2, default_draft_motion_budget,
+                                                  2 * default_draft_motion_budget)) -> List[Dict]:
+    """
+    Accuracy against speedup of draft mode on video_path: one row per fixed stride and per adaptive motion budget
+    (with a maximum stride of max(strides)), with the joint error in pixels against inference on every frame. The
+    visible error is over the joints visible in the full run only, see visible_joints
+    """
+    full_s, _, full_store = timed_landmark_store(video_path)
+    visible = visible_joints(full_store.visibility, full_store.present)
+
+    rows = []
+    configs = [(stride, None) for stride in strides] + [(max(strides), budget) for budget in motion_budgets]
+    for stride, motion_budget in configs:
+        draft_s, inferred_frames, draft_store = timed_landmark_store(video_path, stride, motion_budget)
+
+        both_present = full_store.present & draft_store.present
+        error = np.linalg.norm(draft_store.coords[both_present, :, :2] - full_store.coords[both_present, :, :2],
+                               axis=-1)
+        visible_error = error[:, visible]
+        rows.append({
+            'mode': f"stride {stride}" if motion_budget is None else f"adaptive {motion_budget} (max {stride})",
+            'inferred_fraction': inferred_frames / len(draft_store),
+            'speedup': full_s / draft_s,
+            'mean_error_px': float(error.mean()) if error.size else float('nan'),
+            'p95_error_px': float(np.percentile(error, 95)) if error.size else float('nan'),
+            'mean_visible_error_px': float(visible_error.mean()) if visible_error.size else float('nan')
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    print(f"Landmark reader: {benchmark_landmark_reader()}")
+    print(f"Matrix filter: {benchmark_matrix_filter()}")
+    print(f"Outlier filter: {benchmark_outlier_filter()}")
+    print(f"Overlay rendering: {benchmark_overlay_rendering()}")
+    # Inference needs a clip with a person in it: python -m msk.benchmarks <video_path>
+    if len(sys.argv) > 1:
+        print(f"Inference resolution: {benchmark_inference_resolution(sys.argv[1])}")
+        print("Draft mode:")
+        print(pd.DataFrame(benchmark_draft_mode(sys.argv[1])).to_string(index=False, float_format='%.3f'))
+    print(f"LOWESS equivalence: {check_lowess_equivalence()} clip lengths match statsmodels")
+    print(f"LOWESS: {benchmark_lowess()}")
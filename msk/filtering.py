@@ -1,46 +1,308 @@
+import warnings
+from functools import lru_cache
+from typing import Optional, Tuple
+
 import numpy as np
-import pandas as pd
-import statsmodels.api as sm
-from scipy.signal import butter, sosfiltfilt
+from scipy.interpolate import CubicSpline
+from scipy.signal import butter, fftconvolve, sosfilt, sosfilt_zi, sosfiltfilt
 
+default_filter_order = 2
+# Cutoff normalized to the Nyquist frequency, used when the clip frame rate is unknown
+default_cutoff_freq = 1/15
+# Cutoff in Hz, equal to the normalized cutoff at 60 fps
+default_cutoff_hz = 2.0
+# Filter windows reach this many cutoff periods on either side of a sample, the impulse response has decayed to ~0.1%
+filter_lag_periods = 1.5
+# Fraction of the clip used by each LOWESS local fit
+default_lowess_frac = 0.08
+# LOWESS weights at or below this value count as zero, as in statsmodels
+lowess_min_weight = 1e-12
+# Signal filters selectable in filter_signals
+filter_strategies = ('low_pass', 'lowess')
+# Outliers jump away from both neighbours and straight back, by more than outlier_threshold noise scales on top of the
+# local speed of the joint
+outlier_threshold = 6.0
+# Smallest noise scale, relative to the magnitude of the signal. Landmarks are stored as float32, so steady or linearly
+# interpolated joints differ from their neighbours by round-off only, which is not a jump
+outlier_min_relative_scale = 1e-5
 
-def low_pass_filter(x: np.ndarray, order: int = 2, cutoff_freq: float = 1/15) -> np.ndarray:
-    # Low - pass butterworth filter
-    sos = butter(order, cutoff_freq, output='sos')
-    y = sosfiltfilt(sos, x)
-    return y
 
+@lru_cache(maxsize=32)
+def design_low_pass(order: int, cutoff_freq: float, fs: Optional[float] = None) -> np.ndarray:
+    """
+    Butterworth low pass second order sections, designed once per (order, cutoff_freq, fs).
+    cutoff_freq is normalized to the Nyquist frequency when fs is None, in Hz otherwise
+    """
+    return butter(order, cutoff_freq, output='sos', fs=fs)
 
-def outlier_filter(x: pd.Series, quantile: float = 0.99) -> np.ndarray:
-    # Apply outlier removal filter to eliminate points beyond 99 percentile
-    ser = x.dropna()
 
-    diff_abs_ser = ser.diff().abs()
+def filter_cutoff(fps: Optional[float], cutoff_hz: float) -> Tuple[float, Optional[float]]:
+    """
+    Returns the cutoff_freq and fs to design the low pass filter for a clip. The cutoff is in Hz at the clip frame rate
+    when it is known and below Nyquist, otherwise the default normalized cutoff is used
+    """
+    if fps and 0 < cutoff_hz < fps / 2:
+        return cutoff_hz, fps
+    return default_cutoff_freq, None
+
 
-    # Get 99 percentile value
-    p99 = diff_abs_ser.quantile(quantile)
+def filter_lag_frames(fps: Optional[float], cutoff_hz: float = default_cutoff_hz) -> int:
+    """
+    Number of samples on either side of a sample that contribute to its low pass filtered value
+    """
+    cutoff_freq, fs = filter_cutoff(fps, cutoff_hz)
+    samples_per_period = fs / cutoff_freq if fs else 2 / cutoff_freq
+    return int(np.ceil(filter_lag_periods * samples_per_period))
 
-    # Replace above p99 values with None and then forward fill
-    ser[diff_abs_ser >= p99] = None
-    x = ser.fillna(method='ffill').to_numpy()
 
+def interpolate_gaps(x: np.ndarray, method: str = 'linear') -> np.ndarray:
+    """
+    Interpolates NaN gaps along axis 0 of a (frames, signals) matrix, linearly or with a cubic spline through the valid
+    samples. Leading and trailing gaps take the nearest valid value, all NaN columns are left as they are
+    """
+    if method not in ('linear', 'cubic'):
+        raise ValueError(f"Unknown interpolation method {method}, expected 'linear' or 'cubic'")
+
+    nan_mask = np.isnan(x)
+    if not nan_mask.any():
+        return x
+
+    x = x.copy()
+    frames = np.arange(x.shape[0])
+    for col in np.flatnonzero(nan_mask.any(axis=0)):
+        valid = ~nan_mask[:, col]
+        if not valid.any():
+            continue
+
+        filled = np.interp(frames, frames[valid], x[valid, col])
+        if method == 'cubic' and valid.sum() > 3:
+            # Spline only inside the valid range, no extrapolation past the first and last valid samples
+            inside = (frames > frames[valid][0]) & (frames < frames[valid][-1])
+            filled[inside] = CubicSpline(frames[valid], x[valid, col])(frames[inside])
+        x[~valid, col] = filled[~valid]
     return x
 
 
-def lowess_filter(x: np.ndarray) -> np.ndarray:
-    # Non parametric curve smoother - lowess filter
-    lowess = sm.nonparametric.lowess
-    y = lowess(x, np.arange(len(x)), frac=0.08)[:, 1]
+def low_pass_filter_matrix(x: np.ndarray, order: int = default_filter_order,
+                           cutoff_freq: float = default_cutoff_freq, fs: Optional[float] = None) -> np.ndarray:
+    """
+    Low pass filters every column of a (frames, signals) matrix in one sosfiltfilt call along axis 0. NaN gaps from
+    dropped detections are interpolated before filtering and put back in the output
+    """
+    x = np.asarray(x, dtype=float)
+    nan_mask = np.isnan(x)
+
+    y = sosfiltfilt(design_low_pass(order, cutoff_freq, fs), interpolate_gaps(x), axis=0)
+
+    y[nan_mask] = np.nan
+    return y
+
+
+class OnlineLowPassFilter:
+    """
+    Causal low pass filter that consumes one row of signals at a time with persistent sosfilt state, for a live preview
+    while the clip is still being processed. Rows with NaN (dropped detections) hold the last output, the state is
+    restarted from the next row when the gap is longer than the filter settling time.
+    """
+
+    def __init__(self, n_signals: int, fps: Optional[float] = None, cutoff_hz: float = default_cutoff_hz,
+                 order: int = default_filter_order):
+        cutoff_freq, fs = filter_cutoff(fps, cutoff_hz)
+        self.sos = design_low_pass(order, cutoff_freq, fs)
+        self.max_gap = filter_lag_frames(fps, cutoff_hz)
+        self.n_signals = n_signals
+
+        self._zi = None
+        self._gap = 0
+        self._last = np.full(n_signals, np.nan)
+
+    def update(self, x: np.ndarray) -> np.ndarray:
+        """
+        Returns the filtered value of the row x (n_signals,)
+        """
+        x = np.asarray(x, dtype=float).reshape(1, self.n_signals)
+
+        if np.isnan(x).any():
+            self._gap = self._gap + 1
+            return self._last.copy()
+
+        if self._zi is None or self._gap > self.max_gap:
+            # Start in steady state at the first value to avoid a step response from zero
+            self._zi = sosfilt_zi(self.sos)[:, :, np.newaxis] * x
+        self._gap = 0
+
+        y, self._zi = sosfilt(self.sos, x, axis=0, zi=self._zi)
+        self._last = y[0]
+        return self._last.copy()
+
+
+def outlier_mask(x: np.ndarray, threshold: float = outlier_threshold,
+                 interpolated: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Flags isolated spikes in every column of a (frames, signals) matrix in one pass: samples that jump away from both
+    neighbours in the same direction and straight back, by more than threshold noise scales plus the local speed (the
+    larger step between the neighbours and the frames past them). Fast smooth motion, a whip or a release, keeps moving
+    or slows into its turns and is not flagged. The noise scale of a column is the MAD of its second differences
+    (x[i] - (x[i-1] + x[i+1]) / 2). The two frames at either end of the clip are never flagged
+    :param interpolated: optional boolean mask of the frames filled in by interpolation (draft mode). Their second
+    differences are zero by construction and are left out of the noise scale
+    """
+    x_filled = interpolate_gaps(x)
+    mask = np.zeros(x_filled.shape, dtype=bool)
+    if x_filled.shape[0] < 5:
+        return mask
+
+    steps = np.diff(x_filled, axis=0)
+    # Jump of frame i away from its neighbours, 0 unless both sides move the same way
+    before, after = steps[1:-2], -steps[2:-1]
+    jump = np.where(before * after > 0, np.minimum(np.abs(before), np.abs(after)), 0)
+    local_speed = np.maximum(np.abs(steps[:-3]), np.abs(steps[3:]))
+
+    second_diff = x_filled[1:-1] - (x_filled[:-2] + x_filled[2:]) / 2
+    if interpolated is not None and np.any(interpolated[1:-1]):
+        second_diff[np.asarray(interpolated[1:-1], dtype=bool)] = np.nan
+    median = np.nanmedian if np.isnan(second_diff).any() else np.median
+    with warnings.catch_warnings():
+        # Joints never detected are all NaN columns, their scale is NaN and nothing is flagged
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mad = median(np.abs(second_diff - median(second_diff, axis=0)), axis=0)
+        magnitude = np.nanmax(np.abs(x_filled), axis=0)
+    # Noise standard deviation, var(second_diff) = 1.5 var(noise)
+    scale = np.maximum(1.4826 * mad / np.sqrt(1.5), np.maximum(outlier_min_relative_scale * magnitude, 1e-9))
+
+    with np.errstate(invalid='ignore'):
+        mask[2:-2] = jump > threshold * scale + local_speed
+    return mask
+
+
+def outlier_filter_matrix(x: np.ndarray, threshold: float = outlier_threshold, method: str = 'linear',
+                          interpolated: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Replaces the outliers flagged by outlier_mask with values interpolated from their neighbours (linear or cubic
+    spline). NaN gaps in the input stay NaN. interpolated marks the draft mode frames left out of the noise scale
+    """
+    x = np.asarray(x, dtype=float)
+    nan_mask = np.isnan(x)
+
+    y = x.copy()
+    y[outlier_mask(x, threshold, interpolated)] = np.nan
+    y = interpolate_gaps(y, method)
+
+    y[nan_mask] = np.nan
     return y
 
 
-def filter_signal(x: pd.Series) -> np.ndarray:
+def _correlate_frames(x: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    # Correlates every column of x with a kernel centred on each frame
+    return fftconvolve(x, kernel[::-1, np.newaxis], mode='same', axes=0)
+
+
+def _local_linear_intercept(s0, s1, s2, t0, t1) -> np.ndarray:
+    # Intercept of the weighted local linear fit from its weighted sums. As in statsmodels, the weighted variance of the
+    # offsets is floored at 1e-12. It is normalized by s0, so the round-off left in the FFT sums of a degenerate fit
+    # stays below the floor instead of becoming the divisor
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_offset = s1 / s0
+        mean_x = t0 / s0
+        variance = np.maximum(s2 / s0 - mean_offset ** 2, 1e-12)
+        return mean_x - mean_offset * (t1 / s0 - mean_offset * mean_x) / variance
+
+
+def _lowess_edge_fits(x: np.ndarray, robustness: np.ndarray, frames: np.ndarray, start: int, k: int) -> np.ndarray:
     """
-    Returns a filtered signal output
+    LOWESS fits at frames whose k nearest neighbours are the window [start, start + k) at a clip end
     """
+    window = np.arange(start, start + k)
+    offsets = (window[np.newaxis, :] - frames[:, np.newaxis]).astype(float)
+    radius = np.abs(offsets).max(axis=1, keepdims=True)
+    weights = np.clip(1 - (np.abs(offsets) / np.maximum(radius, 1)) ** 3, 0, None) ** 3
+
+    r = robustness[window]
+    rx = r * x[window]
+    y = _local_linear_intercept(weights @ r, (weights * offsets) @ r, (weights * offsets ** 2) @ r,
+                                weights @ rx, (weights * offsets) @ rx)
+
+    # Fits with less than two non zero weights keep the input value
+    nonzero_weights = ((weights[:, :, np.newaxis] * r[np.newaxis]) > lowess_min_weight).sum(axis=1)
+    return np.where(nonzero_weights >= 2, y, x[frames])
+
+
+def lowess_filter_matrix(x: np.ndarray, frac: float = default_lowess_frac, iterations: int = 3) -> np.ndarray:
+    """
+    LOWESS smoother for every column of a (frames, signals) matrix, equivalent to statsmodels lowess on each column.
+    Frames are evenly spaced, so away from the clip ends the tricube weighted local linear fit at every frame is made
+    of correlations of the (robustness weighted) signals with three fixed kernels, computed with FFTs for all columns
+    at once. Frames at the clip ends, where the neighbourhood is shifted, are fitted with a few matrix products.
+    iterations robustifying passes downweight outliers with bisquare weights on the residuals. NaN gaps are
+    interpolated before and restored after smoothing
+    """
+    x = np.asarray(x, dtype=float)
+    nan_mask = np.isnan(x)
+    x = interpolate_gaps(x)
+
+    n = x.shape[0]
+    # Each fit uses the k nearest frames, tricube weights vanish at the farthest one
+    k = min(max(int(frac * n + 1e-10), 2), n)
+    radius = k // 2
+    offsets = np.arange(-radius, radius + 1, dtype=float)
+    kernel = np.clip(1 - (np.abs(offsets) / radius) ** 3, 0, None) ** 3
+
+    head = np.arange(0, min(radius, n))
+    tail = np.arange(max(n - radius, radius), n)
+
+    robustness = np.ones_like(x)
+    for iteration in range(iterations + 1):
+        y = _local_linear_intercept(_correlate_frames(robustness, kernel),
+                                    _correlate_frames(robustness, offsets * kernel),
+                                    _correlate_frames(robustness, offsets ** 2 * kernel),
+                                    _correlate_frames(robustness * x, kernel),
+                                    _correlate_frames(robustness * x, offsets * kernel))
+        # Fits with less than two non zero weights keep the input value, the count is rounded from FFT sums
+        nonzero_weights = np.rint(_correlate_frames((robustness > lowess_min_weight).astype(float),
+                                                    (kernel > lowess_min_weight).astype(float)))
+        y = np.where(nonzero_weights >= 2, y, x)
+        y[head] = _lowess_edge_fits(x, robustness, head, 0, k)
+        y[tail] = _lowess_edge_fits(x, robustness, tail, n - k, k)
+        y = np.where(np.isfinite(y), y, x)
+
+        if iteration == iterations:
+            break
+
+        # Bisquare robustness weights from the residuals, scaled by six median absolute residuals. When over half of
+        # the residuals are 0, only the samples with a 0 residual keep their weight. Residuals at the round-off level
+        # of the signal count as 0, so exact local fits do not get weights from round-off noise
+        residuals = np.abs(x - y)
+        residuals[residuals <= 1e-12 * np.maximum(np.abs(x).max(axis=0), 1)] = 0
+        scale = 6 * np.median(residuals, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = np.where(scale > 0, residuals / scale, residuals > 0)
+        robustness = (1 - np.minimum(scaled, 1) ** 2) ** 2
+
+    y[nan_mask] = np.nan
+    return y
+
+
+def filter_signals(x: np.ndarray, fps: Optional[float] = None, cutoff_hz: float = default_cutoff_hz,
+                   strategy: str = 'low_pass', reject_outliers: bool = True,
+                   interpolated: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Returns the filtered output of every column of a (frames, signals) matrix sampled at fps, at the default
+    normalized cutoff when fps is unknown. interpolated optionally marks the rows filled in by draft mode, see
+    outlier_mask
+    """
+    if strategy not in filter_strategies:
+        raise ValueError(f"Unknown filter strategy {strategy}, expected one of {filter_strategies}")
+
+    # Outlier removal
+    if reject_outliers:
+        x = outlier_filter_matrix(x, interpolated=interpolated)
+
+    if strategy == 'lowess':
+        return lowess_filter_matrix(x)
+
+    cutoff_freq, fs = filter_cutoff(fps, cutoff_hz)
 
     # Lowpass filter
-    # x = outlier_filter(x)
-    x = low_pass_filter(x)
+    x = low_pass_filter_matrix(x, cutoff_freq=cutoff_freq, fs=fs)
 
     return x
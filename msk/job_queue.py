@@ -0,0 +1,266 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from msk.result_cache import ResultCache, cache_key, digest_bytes, digest_file
+from msk.uploaded_video_file import UploadedFile
+
+jobs_dir_name = 'xray_jobs'
+jobs_db_file_name = 'jobs.sqlite'
+job_inputs_dir_name = 'inputs'
+job_previews_dir_name = 'previews'
+
+# Job life cycle: queued -> running -> done | failed
+job_queued = 'queued'
+job_running = 'running'
+job_done = 'done'
+job_failed = 'failed'
+
+# Workers write progress and the preview image at most this often
+progress_interval_s = 1.0
+
+jobs_table = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    source_name TEXT NOT NULL,
+    video_path TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+
+def connect_jobs_db(db_path: str) -> sqlite3.Connection:
+    # Connections are opened per operation, the table is shared by the app threads and the worker processes
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def update_job(db_path: str, job_id: str, **fields) -> None:
+    fields['updated'] = time.time()
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    with connect_jobs_db(db_path) as connection:
+        connection.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+
+def _run_job(db_path: str, job_id: str, video_path: str, options: Dict, preview_path: str) -> Dict[str, str]:
+    """
+    Runs the X-RAY pipeline of a job in a worker process. Progress and the latest preview frame are written for the UI
+    to poll. Returns the artifact paths, they are moved into the result cache by the queue
+    """
+    update_job(db_path, job_id, status=job_running, progress=0.0)
+
+    cap = cv2.VideoCapture(video_path)
+    frame_count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 1)
+    cap.release()
+
+    last_update = 0.0
+    # The preview is written next to preview_path and renamed over it, so the UI never reads a half written image.
+    # The temporary name keeps the image extension cv2.imwrite picks the encoder by
+    preview_root, preview_ext = os.path.splitext(preview_path)
+    preview_tmp_path = f"{preview_root}.tmp{preview_ext}"
+
+    def report_progress(frame: int, image: np.ndarray) -> None:
+        nonlocal last_update
+        if time.time() - last_update < progress_interval_s:
+            return
+        last_update = time.time()
+        if cv2.imwrite(preview_tmp_path, image):
+            os.replace(preview_tmp_path, preview_path)
+        update_job(db_path, job_id, progress=min(frame / frame_count, 1.0))
+
+    uploaded_file = UploadedFile(video_path, **options)
+    uploaded_file.run_pipeline(preview=report_progress)
+
+    return {
+        'tracker': uploaded_file.tracker_path,
+        'annotated_video': uploaded_file.annotated_video_path,
+        'filtered_video': uploaded_file.filt_video_path
+    }
+
+
+class JobQueue:
+    """
+    Background processing of uploaded videos on a pool of worker processes, so Streamlit sessions only enqueue and
+    poll. Jobs live in a SQLite table keyed by the result cache key of the video (content digest and pipeline
+    parameters): uploading a video that is queued, running or cached joins the existing job instead of starting a new
+    one. Finished artifacts are moved into result_cache and served from there.
+    One JobQueue is meant to be shared by every session of the app process.
+    """
+
+    def __init__(self, result_cache: ResultCache, jobs_dir: str = jobs_dir_name, workers: Optional[int] = None):
+        self.result_cache = result_cache
+        # Absolute paths, they are handed to the worker processes
+        self.jobs_dir = os.path.abspath(jobs_dir)
+        self.db_path = os.path.join(self.jobs_dir, jobs_db_file_name)
+        self.inputs_dir = os.path.join(self.jobs_dir, job_inputs_dir_name)
+        self.previews_dir = os.path.join(self.jobs_dir, job_previews_dir_name)
+        self._lock = threading.Lock()
+        self._executor_lock = threading.Lock()
+
+        os.makedirs(self.inputs_dir, exist_ok=True)
+        os.makedirs(self.previews_dir, exist_ok=True)
+        with connect_jobs_db(self.db_path) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(jobs_table)
+
+        # Spawned workers, forking the threaded Streamlit server is not safe. Each job runs inference in one process,
+        # so workers bounds the cores used by X-RAY across all sessions
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self._executor = self._new_executor()
+
+        self._resume_jobs()
+
+    def _resume_jobs(self) -> None:
+        # Jobs left queued or running by a previous app process are started again
+        with connect_jobs_db(self.db_path) as connection:
+            rows = connection.execute("SELECT * FROM jobs WHERE status IN (?, ?)", (job_queued, job_running)).fetchall()
+        for row in rows:
+            if os.path.exists(row['video_path']):
+                self._start(row['job_id'], row['source_name'], row['video_path'], json.loads(row['options']))
+            else:
+                update_job(self.db_path, row['job_id'], status=job_failed, error="Input video is missing")
+
+    def submit(self, video_path: str, source_name: str = "", retry: bool = False, digest: Optional[str] = None,
+               **options) -> str:
+        """
+        Enqueues the processing of video_path unless the same video and options are already queued, running or cached.
+        A job that failed is returned as it is, it only runs again when retry is asked for
+        :param digest: content digest of video_path if already known, saves hashing the video again
+        :param options: UploadedFile pipeline options, for instance cutoff_hz or draft_stride
+        :return: job id to poll with status
+        """
+        job_id = cache_key(digest or digest_file(video_path), UploadedFile(video_path, **options).pipeline_params())
+
+        with self._lock:
+            job = self.status(job_id)
+            if job is not None and job['status'] in (job_queued, job_running):
+                return job_id
+            if job is not None and job['status'] == job_failed and not retry:
+                return job_id
+
+            if self.result_cache.get(job_id) is not None:
+                self._upsert(job_id, source_name, video_path, options, job_done, progress=1.0)
+                return job_id
+
+            # The job gets its own copy of the video, the caller is free to remove video_path once submit returns
+            job_video_path = os.path.join(self.inputs_dir, job_id + os.path.splitext(video_path)[1])
+            shutil.copyfile(video_path, job_video_path)
+
+            self._upsert(job_id, source_name, job_video_path, options, job_queued)
+            self._start(job_id, source_name, job_video_path, options)
+
+        return job_id
+
+    def submit_upload(self, bytes_data: bytes, file_name: str, retry: bool = False, digest: Optional[str] = None,
+                      **options) -> Tuple[str, str]:
+        """
+        Enqueues an uploaded video, see submit. The bytes are written to a file of their own in the inputs directory,
+        so uploads of concurrent sessions never share a path, and the file is removed once the job has its copy
+        :param digest: content digest of bytes_data if already known
+        :return: job id to poll with status and the content digest of the video
+        """
+        digest = digest or digest_bytes(bytes_data)
+        with tempfile.NamedTemporaryFile(dir=self.inputs_dir, prefix=f"upload_{digest}_",
+                                         suffix=os.path.splitext(file_name)[1], delete=False) as f:
+            f.write(bytes_data)
+        try:
+            job_id = self.submit(f.name, source_name=file_name, retry=retry, digest=digest, **options)
+        finally:
+            os.remove(f.name)
+        return job_id, digest
+
+    def _upsert(self, job_id: str, source_name: str, video_path: str, options: Dict, status: str,
+                progress: float = 0.0) -> None:
+        now = time.time()
+        with connect_jobs_db(self.db_path) as connection:
+            connection.execute(
+                    "INSERT OR REPLACE INTO jobs (job_id, source_name, video_path, options, status, progress, error, "
+                    "created, updated) VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?)",
+                    (job_id, source_name, video_path, json.dumps(options), status, progress, now, now))
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """
+        Replaces the pool after a worker process died (killed or out of memory): a broken pool fails every job it holds
+        and refuses new ones. Every job of the broken pool ends up here, only the first one replaces it
+        """
+        with self._executor_lock:
+            if self._executor is broken:
+                print("X-RAY worker process died, starting a new worker pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._new_executor()
+            return self._executor
+
+    def _start(self, job_id: str, source_name: str, video_path: str, options: Dict) -> None:
+        executor = self._executor
+        try:
+            future = executor.submit(_run_job, self.db_path, job_id, video_path, options, self.preview_path(job_id))
+        except BrokenProcessPool:
+            executor = self._replace_executor(executor)
+            future = executor.submit(_run_job, self.db_path, job_id, video_path, options, self.preview_path(job_id))
+        future.add_done_callback(lambda f: self._finish(job_id, source_name, video_path, options, executor, f))
+
+    def _finish(self, job_id: str, source_name: str, video_path: str, options: Dict, executor: ProcessPoolExecutor,
+                future: Future) -> None:
+        # Runs in this process, the workers only produce the artifacts and the result cache is written from here
+        try:
+            artifact_paths = future.result()
+            pipeline_params = UploadedFile(video_path, **options).pipeline_params()
+            self.result_cache.put(job_id, artifact_paths, source_name=source_name, pipeline_params=pipeline_params)
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            job = self.status(job_id)
+            if job is not None and job['status'] == job_queued:
+                # The job was still waiting for a worker, it did not take the pool down and runs on the new one
+                self._start(job_id, source_name, video_path, options)
+            else:
+                update_job(self.db_path, job_id, status=job_failed,
+                           error="BrokenProcessPool: the worker process died while processing the video")
+            return
+        except Exception as e:
+            update_job(self.db_path, job_id, status=job_failed, error=f"{type(e).__name__}: {e}")
+            return
+
+        update_job(self.db_path, job_id, status=job_done, progress=1.0)
+        for path in (video_path, self.preview_path(job_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def preview_path(self, job_id: str) -> str:
+        return os.path.join(self.previews_dir, f"{job_id}.jpg")
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """
+        Returns the job row (status, progress, error, ...) or None for an unknown job
+        """
+        with connect_jobs_db(self.db_path) as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def result(self, job_id: str) -> Optional[Dict[str, str]]:
+        """
+        Artifact paths of a finished job from the result cache, None if the job is not done or was evicted
+        """
+        return self.result_cache.get(job_id)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
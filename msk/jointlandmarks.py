@@ -3,12 +3,11 @@ import pandas as pd
 from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmark
 from itertools import chain
 
-from typing import List
-import csv
+from typing import List, Optional
 
-from msk.filtering import filter_signal
+from msk.filtering import filter_signals, default_cutoff_hz
 
-joint_names = ['nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye', 'right_eye_outer',
+joint_names = ['nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye',
                'right_eye_outer', 'left_ear', 'right_ear', 'mouth_left', 'mouth_right', 'left_shoulder',
                'right_shoulder', 'left_elbow', 'right_elbow', 'left_wrist', 'right_wrist', 'left_pinky',
                'right_pinky', 'left_index', 'right_index', 'left_thumb', 'right_thumb', 'left_hip', 'right_hip',
@@ -35,45 +34,129 @@ def add_x_y_z(joint_name: str) -> List[str]:
 joint_names_xyz_list = get_joints_xyz_list()
 
 
-def joints_list_to_csv(joint_landmarks_list: List[List[float]], output_file_path: str) -> None:
+class LandmarkStore:
     """
-    Creates a csv file from a list of joint landmarks
+    Columnar store of the pose landmarks of a video, one row per decoded frame.
+    coords holds pixel x, y and the z coordinate as float32 (frames, 33, 3), NaN where no pose was detected.
+    visibility holds the landmark visibility scores (frames, 33) and present is True for frames with a detected pose.
+    interpolated is True for the present frames filled in between detections rather than detected (draft mode).
+    Arrays are preallocated for the expected frame count and grow if the video turns out longer.
     """
 
-    # for joint_name in joint_names:
-    #     joint_names_xyz_list.extend(add_x_y_z(joint_name))
+    def __init__(self, capacity: int, n_joints: int = len(joint_names), fps: float = 0.0, width: int = 0,
+                 height: int = 0):
+        # Source video timing and resolution
+        self.fps = fps
+        self.width = width
+        self.height = height
 
-    with open(output_file_path, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=joint_names_xyz_list)
+        capacity = max(capacity, 1)
+        self._coords = np.full((capacity, n_joints, 3), np.nan, dtype=np.float32)
+        self._visibility = np.zeros((capacity, n_joints), dtype=np.float32)
+        self._present = np.zeros(capacity, dtype=bool)
+        self._interpolated = np.zeros(capacity, dtype=bool)
+        self.frames = 0
+
+    def __len__(self) -> int:
+        return self.frames
+
+    @property
+    def coords(self) -> np.ndarray:
+        return self._coords[:self.frames]
+
+    @property
+    def visibility(self) -> np.ndarray:
+        return self._visibility[:self.frames]
+
+    @property
+    def present(self) -> np.ndarray:
+        return self._present[:self.frames]
+
+    @property
+    def interpolated(self) -> np.ndarray:
+        return self._interpolated[:self.frames]
+
+    def _grow(self, min_capacity: int) -> None:
+        capacity = max(min_capacity, 2 * self._present.shape[0])
+        extra = capacity - self._present.shape[0]
+        self._coords = np.concatenate([self._coords,
+                                       np.full((extra,) + self._coords.shape[1:], np.nan, dtype=np.float32)])
+        self._visibility = np.concatenate([self._visibility,
+                                           np.zeros((extra,) + self._visibility.shape[1:], dtype=np.float32)])
+        self._present = np.concatenate([self._present, np.zeros(extra, dtype=bool)])
+        self._interpolated = np.concatenate([self._interpolated, np.zeros(extra, dtype=bool)])
+
+    def set_frame(self, frame: int, coords: Optional[np.ndarray] = None,
+                  visibility: Optional[np.ndarray] = None) -> None:
+        """
+        Records a decoded frame. coords (33, 3) and visibility (33,) are given when a pose was detected
+        """
+        if frame >= self._present.shape[0]:
+            self._grow(frame + 1)
+        self.frames = max(self.frames, frame + 1)
 
-        writer.writeheader()
+        if coords is not None:
+            self._coords[frame] = coords
+            self._present[frame] = True
+            if visibility is not None:
+                self._visibility[frame] = visibility
 
-        for joints_frame in joint_landmarks_list:
-            row_to_write = dict(zip(joint_names_xyz_list, list(chain(*joints_frame))))
-            writer.writerow(row_to_write)
+    def interpolate_frames(self, start: int, end: int) -> None:
+        """
+        Fills the frames strictly between the present frames start and end by linear interpolation of their coords and
+        visibility, and marks them present and interpolated
+        """
+        if end - start < 2:
+            return
+
+        weights = (np.arange(1, end - start, dtype=np.float32) / (end - start))[:, np.newaxis]
+        self._coords[start + 1:end] = (1 - weights[..., np.newaxis]) * self._coords[start] \
+            + weights[..., np.newaxis] * self._coords[end]
+        self._visibility[start + 1:end] = (1 - weights) * self._visibility[start] + weights * self._visibility[end]
+        self._present[start + 1:end] = True
+        self._interpolated[start + 1:end] = True
 
 
-def post_process_tracker_csv(tracker_csv_path: str, image_height: int) -> pd.DataFrame:
-    df = pd.read_csv(tracker_csv_path)
+def post_process_landmarks(landmark_store: LandmarkStore, image_height: int, cutoff_hz: float = default_cutoff_hz,
+                           filter_strategy: str = 'low_pass', reject_outliers: bool = True) -> pd.DataFrame:
+    """
+    Post processes a landmark store without a csv round trip, filtering at the store frame rate. There is one row per
+    video frame, frames without a pose are NaN rows so the filters interpolate across the gap instead of splicing the
+    detections around it together
+    """
+    df = pd.DataFrame(landmark_store.coords.reshape(-1, len(joint_names_xyz_list)).astype(float),
+                      columns=joint_names_xyz_list)
+    return post_process_tracker_df(df, image_height, fps=landmark_store.fps, cutoff_hz=cutoff_hz,
+                                   filter_strategy=filter_strategy, reject_outliers=reject_outliers,
+                                   interpolated=landmark_store.interpolated)
+
 
+def post_process_tracker_df(df: pd.DataFrame, image_height: int, fps: Optional[float] = None,
+                            cutoff_hz: float = default_cutoff_hz, filter_strategy: str = 'low_pass',
+                            reject_outliers: bool = True, interpolated: Optional[np.ndarray] = None) -> pd.DataFrame:
     # Realign image origin to the lower left corner of the image. This is done only for y signals by subtracting the
     # image height
     y_column_names = [col_name for col_name in df.columns if col_name[-2:] == '_y']
     df[y_column_names] = df[y_column_names].transform(lambda x: image_height - x)
 
-    # Add a filter transform and _filt suffix to the filtered signals
-    filt_df = df \
-        .transform(filter_signal) \
+    # Remove outliers and filter every signal in one pass over the matrix, add a _filt suffix to the filtered signals
+    filt_signals = filter_signals(df.to_numpy(dtype=float), fps, cutoff_hz, filter_strategy, reject_outliers,
+                                  interpolated)
+    filt_df = pd.DataFrame(filt_signals, columns=df.columns, index=df.index) \
         .add_suffix('_filt')
 
     df_to_plot = pd.concat([df, filt_df], axis=1)
 
-    # Add a frames column
+    # Add a frames column, the video frame number of every row counted from 1
     df_to_plot['frames'] = np.arange(1, df_to_plot.shape[0]+1)
 
     return df_to_plot
 
 
+# Fields read from every NormalizedLandmark, in the column order of JointLandMarks.get_joint_array
+landmark_fields = ('x', 'y', 'z', 'visibility')
+
+
 class JointLandMarks:
 
     def __init__(self, ele_list: List[NormalizedLandmark], width: float, height: float):
@@ -81,27 +164,14 @@ class JointLandMarks:
         self.width = width
         self.height = height
 
-    @staticmethod
-    def extract_coordinate_from_landmark(ele: NormalizedLandmark, dim: int) -> float:
+    def get_joint_array(self) -> np.ndarray:
         """
-        Get the coordinate from NormalizedLandmark object
-        :param ele: NormalizedLandmark object
-        :param dim: 0 for x, 1 for y, 2 for z
+        Returns the x, y, z and visibility of every joint as a float32 (joints, 4) array, x and y scaled to pixels.
+        Fields are read by name straight into the array and scaled in one multiply
         :return:
         """
-        return ele.ListFields()[dim][1]
-
-    def get_joint_landmarks(self):
-        """
-        Returns joint landmarks as a list of x,y,z coordinates
-        :return:
-        """
-        result = []
-
-        for ele in self.ele_list:
-            ele_x = JointLandMarks.extract_coordinate_from_landmark(ele, 0) * self.width
-            ele_y = JointLandMarks.extract_coordinate_from_landmark(ele, 1) * self.height
-            ele_z = JointLandMarks.extract_coordinate_from_landmark(ele, 2)
-            result.append([ele_x, ele_y, ele_z])
-
-        return result
+        joint_array = np.fromiter(chain.from_iterable((ele.x, ele.y, ele.z, ele.visibility) for ele in self.ele_list),
+                                  dtype=np.float32, count=len(landmark_fields) * len(self.ele_list)) \
+            .reshape(-1, len(landmark_fields))
+        joint_array[:, :2] *= np.array([self.width, self.height], dtype=np.float32)
+        return joint_array
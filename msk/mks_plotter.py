@@ -1,156 +1,309 @@
 import mediapipe as mp
-import pandas as pd
+import numpy as np
 import cv2
-from typing import List, Tuple
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
 
 from mediapipe.python.solutions.pose_connections import POSE_CONNECTIONS
 
-from msk.jointlandmarks import JointLandMarks, joint_names
+from msk.filtering import filter_signals, filter_lag_frames, default_cutoff_hz, OnlineLowPassFilter
+from msk.jointlandmarks import JointLandMarks, LandmarkStore, joint_names, joint_names_xyz_list
+from msk.video_encoder import VideoWriter, close_video_writer, open_video_writer, output_timing
+from msk.pose_pool import read_frames, serial_pose_landmarks, parallel_pose_landmarks, roi_pose_landmarks, \
+    draft_pose_landmarks
 
+pose_settings = dict(
+        model_complexity=2,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.95
+)
 
-def mediapose_mks_plotter(input_file_path: str, annotated_video: str) -> Tuple[List[List[float]], int, int]:
+# Joint index pairs of the skeleton segments, and the joints they touch (each gets one marker)
+connection_pairs = np.array(sorted(POSE_CONNECTIONS), dtype=np.intp)
+connected_joints = np.unique(connection_pairs)
+
+# Memory for the decoded frames waiting on future landmarks, per filtered overlay. The filter look-ahead is shortened
+# to fit, so high frame rate and high resolution clips take the same memory
+frame_buffer_max_bytes = 256 * 2 ** 20
+
+
+class FrameRingBuffer:
     """
-    Returns: a List of x, y, z coordinates of joints, image_width and image_height
+    Bounded FIFO of decoded frames waiting for enough future landmarks to draw their filtered overlay
     """
-    mp_drawing = mp.solutions.drawing_utils
-    mp_drawing_styles = mp.solutions.drawing_styles
-    mp_pose = mp.solutions.pose
 
-    cap = cv2.VideoCapture(input_file_path)
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._frames: Deque[Tuple[int, np.ndarray]] = deque()
 
-    frame_width = int(cap.get(3))
-    frame_height = int(cap.get(4))
+    def __len__(self) -> int:
+        return len(self._frames)
 
-    joint_tracker_list = []
-
-    fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    out = cv2.VideoWriter(annotated_video, fourcc, 10, (frame_width, frame_height))
-    with mp_pose.Pose(
-            model_complexity=2,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.95) as pose:
-        frame = 0
-        while cap.isOpened():
-            success, image = cap.read()
-            if not success:
-                print("Ignoring empty camera frame.")
-                # If loading a video, use 'break' instead of 'continue'.
-                break
-            # print(f"Height: {cap.get(3)}")
-            # print(f"Width: {cap.get(4)}")
-            # To improve performance, optionally mark the image as not writeable to
-            # pass by reference.
-            image.flags.writeable = False
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            results = pose.process(image)
-
-            if results.pose_landmarks:
-                ele = results.pose_landmarks.ListFields()[0][1]  # This list needs to be sent to jointlandmarks
-                joint_landmarks = JointLandMarks(ele, frame_width, frame_height)
-                joint_tracker_list.append(joint_landmarks.get_joint_landmarks())
-
-            # Draw the pose annotation on the image.
-            image.flags.writeable = True
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-            mp_drawing.draw_landmarks(
-                    image,
-                    results.pose_landmarks,
-                    mp_pose.POSE_CONNECTIONS,
-                    landmark_drawing_spec=mp_drawing_styles.get_default_pose_landmarks_style()
-            )
+    def is_full(self) -> bool:
+        return len(self._frames) >= self.capacity
 
-            image = cv2.putText(image, f"Frame-{frame}", (frame_width - 300, frame_height - 50),
-                                cv2.FONT_HERSHEY_SIMPLEX,
-                                1, (0, 0, 255), 2)
+    def push(self, frame: int, image: np.ndarray) -> None:
+        if self.is_full():
+            raise OverflowError(f"Frame buffer is full ({self.capacity} frames)")
+        self._frames.append((frame, image))
 
-            out.write(image)
+    def pop(self) -> Tuple[int, np.ndarray]:
+        return self._frames.popleft()
 
-            frame = frame + 1
 
-            if cv2.waitKey(1) == ord('q'):
-                break
+def buffered_filter_lag(filter_lag: int, draft_stride: int, frame_width: int, frame_height: int) -> Optional[int]:
+    """
+    Filter look-ahead in frames of the single pass filtered overlay, None when the filter_lag + draft_stride buffered
+    BGR frames do not fit in frame_buffer_max_bytes and the overlay is drawn in a second pass instead
+    """
+    max_frames = frame_buffer_max_bytes // max(frame_width * frame_height * 3, 1)
+    return filter_lag if filter_lag + max(draft_stride, 1) <= max_frames else None
+
+
+def put_frame_number(image: np.ndarray, frame: int, frame_width: int, frame_height: int) -> np.ndarray:
+    return cv2.putText(image, f"Frame-{frame}", (frame_width - 300, frame_height - 50),
+                       cv2.FONT_HERSHEY_SIMPLEX,
+                       1, (0, 0, 255), 2)
 
-    out.release()
-    cap.release()
-    cv2.destroyAllWindows()
 
-    print(f"Video file created - {annotated_video}")
+def filter_window(landmark_store: LandmarkStore, frame: int, lag: int, cutoff_hz: float,
+                  reject_outliers: bool = True) -> np.ndarray:
+    """
+    Low pass filters the frames within lag of frame and returns the filtered joints of frame (n_joints, 3). Frames
+    without a pose are NaN rows, interpolated by the filter, so detections are not spliced together across a gap
+    """
+    start = max(0, frame - lag)
+    window = landmark_store.coords[start: frame + lag + 1].reshape(-1, len(joint_names_xyz_list))
+    row = frame - start
 
-    return joint_tracker_list, frame_width, frame_height
+    try:
+        filtered = filter_signals(window, landmark_store.fps, cutoff_hz, reject_outliers=reject_outliers,
+                                  interpolated=landmark_store.interpolated[start: frame + lag + 1])
+    except ValueError:
+        # Too few detections to pad the filter, draw the raw landmarks instead
+        filtered = window
 
+    return filtered[row].reshape(len(joint_names), 3)
 
-def get_joint_xy(joint_number: Tuple, joints_frame: pd.Series) -> Tuple:
-    # Get the joint_name from joint_number
-    joint_name = joint_names[joint_number]
-    return int(joints_frame[f"{joint_name}_x_filt"]), int(joints_frame[f"{joint_name}_y_filt"])
 
+def joints_pixel_array(joints: np.ndarray) -> np.ndarray:
+    """
+    Integer pixel positions (..., n_joints, 2) of joints (..., n_joints, >= 2) in image coordinates, truncated like
+    int(). Computed once for a whole clip so drawing a frame is a plain array lookup
+    """
+    return np.trunc(np.nan_to_num(joints[..., :2])).astype(np.int32)
 
-def draw_filtered_connections(image, joints_series_frame: pd.Series) -> None:
-    # Get the connections to draw
-    for pair in iter(POSE_CONNECTIONS):
-        # Get pairs x,y coordinates
-        p1 = get_joint_xy(pair[0], joints_series_frame)
-        p2 = get_joint_xy(pair[1], joints_series_frame)
 
-        # Add markers to p1 and p2
-        cv2.drawMarker(image, p1, (0, 0, 255),
-                       markerType=cv2.MARKER_STAR, markerSize=5,
-                       thickness=2)
-        cv2.drawMarker(image, p2, (0, 0, 255),
+def draw_filtered_connections(image: np.ndarray, joints_px: np.ndarray) -> None:
+    """
+    Draws the skeleton of one frame of joint pixel positions (n_joints, 2): every segment in a single polylines call,
+    then one marker per joint
+    """
+    cv2.polylines(image, joints_px[connection_pairs], isClosed=False, color=(50, 205, 50), thickness=2,
+                  lineType=cv2.LINE_4)
+
+    for x, y in joints_px[connected_joints].tolist():
+        cv2.drawMarker(image, (x, y), (0, 0, 255),
                        markerType=cv2.MARKER_STAR, markerSize=5,
                        thickness=2)
 
-        # Draw marker from p1 to p2
-        cv2.line(image, p1, p2, (50, 205, 50), thickness=2,
-                 lineType=cv2.LINE_4)
-    return
 
+def write_filtered_frame(out: VideoWriter, frame: int, image: np.ndarray, landmark_store: LandmarkStore, lag: int,
+                         cutoff_hz: float, reject_outliers: bool, frame_width: int, frame_height: int) -> None:
+    if landmark_store.present[frame]:
+        joints = filter_window(landmark_store, frame, lag, cutoff_hz, reject_outliers)
+        draw_filtered_connections(image, joints_pixel_array(joints))
 
-def plot_filtered_tracker_video(path_to_raw_video: str, path_to_filtered_video: str, filtered_df: pd.DataFrame) -> None:
-    cap = cv2.VideoCapture(path_to_raw_video)
-
-    frame_width = int(cap.get(3))
-    frame_height = int(cap.get(4))
+    out.write(put_frame_number(image, frame, frame_width, frame_height))
 
-    # Realign columns in filtered_df
-    y_column_names = [col_name for col_name in filtered_df.columns if col_name[-7:] == '_y_filt']
-    filtered_df[y_column_names] = filtered_df[y_column_names].transform(lambda x: frame_height - x)
 
-    # This works for .avi videos
-    fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    out = cv2.VideoWriter(path_to_filtered_video, fourcc, 10, (frame_width, frame_height))
-    frame = 0
-    while cap.isOpened():
-        success, image = cap.read()
-        if not success or (frame == filtered_df.shape[0]):
-            print("Ignoring empty camera frame.")
-            # If loading a video, use 'break' instead of 'continue'.
-            break
-            # print(f"Height: {cap.get(3)}")
-            # print(f"Width: {cap.get(4)}")
-            # To improve performance, optionally mark the image as not writeable to
-            # pass by reference.
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+def store_pose_landmarks(landmark_store: LandmarkStore, frame: int, pose_landmarks, inferred: bool,
+                         last_pose_frame: Optional[int]) -> Optional[int]:
+    """
+    Records the pose of frame in landmark_store. When a pose follows skipped frames, the skipped frames are filled in by
+    interpolation from last_pose_frame. Returns the last frame with a pose to interpolate from, None after an inferred
+    frame without a pose
+    """
+    if pose_landmarks:
+        joint_array = JointLandMarks(pose_landmarks.landmark, landmark_store.width,
+                                     landmark_store.height).get_joint_array()
+        landmark_store.set_frame(frame, joint_array[:, :3], joint_array[:, 3])
+        if last_pose_frame is not None:
+            landmark_store.interpolate_frames(last_pose_frame, frame)
+        return frame
 
-        # Draw the pose annotation on the image.
-        image.flags.writeable = True
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    landmark_store.set_frame(frame)
+    return None if inferred else last_pose_frame
 
-        draw_filtered_connections(image, filtered_df.iloc[frame, :])
 
-        image = cv2.putText(image, f"Frame-{frame}", (frame_width - 300, frame_height - 50),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            1, (0, 0, 255), 2)
+def write_full_clip_overlay(out: VideoWriter, input_file_path: str, landmark_store: LandmarkStore, cutoff_hz: float,
+                            reject_outliers: bool, output_stride: int, frame_width: int, frame_height: int) -> None:
+    """
+    Draws the filtered overlay in a second decode pass, from the joints filtered over the whole clip like the tracker.
+    For clips whose filter window does not fit in the frame buffer
+    """
+    signals = landmark_store.coords.reshape(len(landmark_store), len(joint_names_xyz_list))
+    try:
+        joints = filter_signals(signals, landmark_store.fps, cutoff_hz, reject_outliers=reject_outliers,
+                                interpolated=landmark_store.interpolated)
+    except ValueError:
+        # Too few frames to pad the filter, draw the raw landmarks instead
+        joints = signals
+    joints_px = joints_pixel_array(joints.reshape(len(landmark_store), len(joint_names), 3))
 
-        out.write(image)
+    cap = cv2.VideoCapture(input_file_path)
+    try:
+        for frame, image in read_frames(cap):
+            if frame >= len(landmark_store):
+                break
+            if frame % output_stride:
+                continue
+            if landmark_store.present[frame]:
+                draw_filtered_connections(image, joints_px[frame])
+            out.write(put_frame_number(image, frame, frame_width, frame_height))
+    finally:
+        cap.release()
+
+
+def mediapose_mks_plotter(input_file_path: str, annotated_video: str, filtered_video: Optional[str] = None,
+                          cutoff_hz: float = default_cutoff_hz, reject_outliers: bool = True,
+                          filter_lag: Optional[int] = None,
+                          inference_workers: int = 1, inference_max_side: Optional[int] = None,
+                          roi_tracking: bool = False, draft_stride: int = 1,
+                          draft_motion_budget: Optional[float] = None,
+                          output_fps: Optional[float] = None, slow_motion: float = 1.0,
+                          preview: Optional[Callable[[int, np.ndarray], None]] = None,
+                          preview_every: int = 10) -> Tuple[LandmarkStore, int, int]:
+    """
+    Runs pose inference on the video and writes the annotated overlay and, if filtered_video is given, the overlay of
+    the joints low pass filtered at cutoff_hz, in the same decode pass while the filter window fits in the frame buffer
+    (buffered_filter_lag) or in a second one (write_full_clip_overlay). Inference runs in the mode picked by the
+    arguments: draft_pose_landmarks, roi_pose_landmarks, parallel_pose_landmarks or serial_pose_landmarks, downscaled
+    to inference_max_side. Overlay frame rate and playback speed follow output_timing. preview is called with the
+    frame number and a BGR preview image every preview_every frames
+    Returns: a LandmarkStore with the joints of every frame, image_width and image_height
+    """
+    mp_drawing = mp.solutions.drawing_utils
+    mp_drawing_styles = mp.solutions.drawing_styles
+    mp_pose = mp.solutions.pose
 
-        frame = frame + 1
+    cap = cv2.VideoCapture(input_file_path)
 
-        if cv2.waitKey(1) == ord('q'):
-            break
+    frame_width = int(cap.get(3))
+    frame_height = int(cap.get(4))
 
-    out.release()
-    cap.release()
-    cv2.destroyAllWindows()
+    landmark_store = LandmarkStore(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), fps=cap.get(cv2.CAP_PROP_FPS),
+                                   width=frame_width, height=frame_height)
+
+    output_stride, writer_fps = output_timing(landmark_store.fps, output_fps, slow_motion)
+
+    if filter_lag is None:
+        filter_lag = filter_lag_frames(landmark_store.fps, cutoff_hz)
+    single_pass_filter = buffered_filter_lag(filter_lag, draft_stride, frame_width, frame_height) is not None
+    if filtered_video is not None and not single_pass_filter:
+        print(f"The {filter_lag} frame filter window does not fit in the frame buffer, the filtered overlay is drawn "
+              f"in a second pass")
+
+    # Skipped draft frames are interpolated once the next pose is known, up to draft_stride frames later
+    frame_buffer = FrameRingBuffer(filter_lag + max(draft_stride, 1) if single_pass_filter else 0)
+
+    online_filter = OnlineLowPassFilter(len(joint_names_xyz_list), landmark_store.fps, cutoff_hz)
+
+    out = None
+    filtered_out = None
+    pose_stream = None
+    try:
+        out = open_video_writer(annotated_video, writer_fps, (frame_width, frame_height))
+        if filtered_video is not None and single_pass_filter:
+            filtered_out = open_video_writer(filtered_video, writer_fps, (frame_width, frame_height))
+
+        # Draft mode takes precedence over the other inference modes, ROI tracking is sequential and ignores
+        # inference_workers
+        if draft_stride > 1 or draft_motion_budget is not None:
+            pose_stream = draft_pose_landmarks(read_frames(cap), pose_settings, draft_stride, draft_motion_budget,
+                                               inference_max_side)
+            frame_stream = pose_stream
+        else:
+            if roi_tracking:
+                pose_stream = roi_pose_landmarks(read_frames(cap), pose_settings, inference_max_side)
+            elif inference_workers > 1:
+                pose_stream = parallel_pose_landmarks(read_frames(cap), pose_settings, inference_workers,
+                                                      max_side=inference_max_side)
+            else:
+                pose_stream = serial_pose_landmarks(read_frames(cap), pose_settings, inference_max_side)
+            # Every frame is inferred
+            frame_stream = ((frame, image, pose_landmarks, True) for frame, image, pose_landmarks in pose_stream)
+
+        annotated_image = None
+        last_pose_frame = None
+        # Pose drawn on the annotated overlay, skipped draft frames keep the last inferred one so the skeleton does not
+        # flicker. Their interpolated joints are only known once the next pose is inferred
+        drawn_landmarks = None
+        for frame, image, pose_landmarks, inferred in frame_stream:
+            last_pose_frame = store_pose_landmarks(landmark_store, frame, pose_landmarks, inferred, last_pose_frame)
+            if inferred:
+                drawn_landmarks = pose_landmarks
+
+            # Preview joints come from a causal online filter, they do not wait on future frames
+            if preview is not None:
+                preview_joints = online_filter.update(landmark_store.coords[frame].reshape(-1))
+                if frame % preview_every == 0:
+                    preview_image = image.copy()
+                    if not np.isnan(preview_joints).any():
+                        draw_filtered_connections(preview_image,
+                                                  joints_pixel_array(preview_joints.reshape(len(joint_names), 3)))
+                    preview(frame, put_frame_number(preview_image, frame, frame_width, frame_height))
+
+            # Frames decimated from the overlay videos are neither drawn nor encoded
+            if frame % output_stride:
+                continue
+
+            # Draw the pose annotation on a reused buffer, the decoded frame is kept clean for the filtered overlay
+            if filtered_out is None:
+                annotated_image = image
+            else:
+                if annotated_image is None:
+                    annotated_image = np.empty_like(image)
+                np.copyto(annotated_image, image)
+            mp_drawing.draw_landmarks(
+                    annotated_image,
+                    drawn_landmarks,
+                    mp_pose.POSE_CONNECTIONS,
+                    landmark_drawing_spec=mp_drawing_styles.get_default_pose_landmarks_style()
+            )
 
-    return
\ No newline at end of file
+            out.write(put_frame_number(annotated_image, frame, frame_width, frame_height))
+
+            if filtered_out is not None:
+                if frame_buffer.is_full():
+                    write_filtered_frame(filtered_out, *frame_buffer.pop(), landmark_store, filter_lag,
+                                         cutoff_hz, reject_outliers, frame_width, frame_height)
+                frame_buffer.push(frame, image)
+
+        # Flush the frames still waiting on future landmarks
+        while len(frame_buffer):
+            write_filtered_frame(filtered_out, *frame_buffer.pop(), landmark_store, filter_lag,
+                                 cutoff_hz, reject_outliers, frame_width, frame_height)
+
+        # Writers are cleared once released, so a failing release does not leave the other one open
+        out, annotated_out = None, out
+        annotated_out.release()
+        print(f"Video file created - {annotated_video}")
+        if filtered_video is not None and not single_pass_filter:
+            filtered_out = open_video_writer(filtered_video, writer_fps, (frame_width, frame_height))
+            write_full_clip_overlay(filtered_out, input_file_path, landmark_store, cutoff_hz, reject_outliers,
+                                    output_stride, frame_width, frame_height)
+        if filtered_out is not None:
+            filtered_out, finished_out = None, filtered_out
+            finished_out.release()
+            print(f"Video file created - {filtered_video}")
+    finally:
+        # On errors: stop the inference workers, and kill the encoders so no ffmpeg process waits on its input
+        if pose_stream is not None:
+            pose_stream.close()
+        for writer in (out, filtered_out):
+            if writer is not None:
+                close_video_writer(writer)
+        cap.release()
+
+    return landmark_store, frame_width, frame_height
@@ -0,0 +1,362 @@
+import cv2
+import mediapipe as mp
+import numpy as np
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain, islice
+from multiprocessing.shared_memory import SharedMemory
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmarkList
+
+# Pose instance owned by each worker process, created once by the pool initializer
+_worker_pose = None
+
+# Suggested longest side for downscaled inference (inference_max_side), 720p. MediaPipe finds the person on a small copy
+# of the frame but runs the landmark model on a 256 px crop around them cut from the frame it is given, so the frame has
+# to keep the person well above 256 px. See benchmark_inference_resolution
+default_inference_max_side = 1280
+
+# ROI tracking: the crop is the box around the previous pose, padded by roi_padding of its longest side on every side,
+# and the full frame is searched again when the mean landmark visibility in the crop drops below roi_min_visibility
+roi_padding = 0.25
+roi_min_visibility = 0.5
+# Crops covering more of the frame than this are not worth cropping
+roi_max_area_fraction = 0.7
+
+# Process pool inference: frames per chunk, and frames of the previous chunk replayed first to seed the tracker state
+parallel_chunk_size = 128
+parallel_warmup_frames = 8
+# Memory for the decoded frames in flight to the inference workers. Chunks are shortened to fit, but not below
+# parallel_warmup_frames
+parallel_max_bytes = 2 * 2 ** 30
+
+# Adaptive draft mode: suggested largest joint displacement, as a fraction of the frame, between two inferred frames.
+# Only joints with a visibility of at least draft_min_visibility in both poses are measured, the positions of hidden
+# joints are guesses that jump around from frame to frame
+default_draft_motion_budget = 0.02
+draft_min_visibility = 0.5
+
+
+def _init_worker(pose_kwargs: Dict) -> None:
+    global _worker_pose
+    _worker_pose = mp.solutions.pose.Pose(**pose_kwargs)
+
+
+def _process_chunk(block_name: str, shape: Tuple[int, ...], dtype: str, warmup: int,
+                   max_side: Optional[int]) -> List[Optional[NormalizedLandmarkList]]:
+    """
+    Runs pose inference over a chunk of BGR frames (frames, height, width, 3) in the shared memory block block_name,
+    downscaled to max_side if given. The first warmup frames overlap the previous chunk and only seed the tracker
+    state, their results are dropped
+    """
+    block = SharedMemory(name=block_name)
+    landmarks = _process_images(np.ndarray(shape, dtype=dtype, buffer=block.buf), max_side)
+    # The block is only closed once no array uses it. After an error it stays mapped until the worker exits, the
+    # caller unlinks it either way
+    block.close()
+    return landmarks[warmup:]
+
+
+def _process_images(images: np.ndarray, max_side: Optional[int]) -> List[Optional[NormalizedLandmarkList]]:
+    _worker_pose.reset()
+    rgb_image = inference_buffer(images[0], max_side)
+    return [_worker_pose.process(to_inference_rgb(image, rgb_image)).pose_landmarks for image in images]
+
+
+def read_frames(cap: cv2.VideoCapture) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Yields the frame number and decoded BGR image of every frame left in the capture
+    """
+    frame = 0
+    while cap.isOpened():
+        success, image = cap.read()
+        if not success:
+            print("Ignoring empty camera frame.")
+            # If loading a video, use 'break' instead of 'continue'.
+            break
+        yield frame, image
+        frame = frame + 1
+
+
+def inference_size(frame_width: int, frame_height: int, max_side: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Returns the (width, height) pose inference runs at: the frame size scaled down to max_side on its longest side with
+    the aspect ratio kept, or the frame size itself if max_side is None or the frame already fits
+    """
+    if max_side is None or max(frame_width, frame_height) <= max_side:
+        return frame_width, frame_height
+
+    scale = max_side / max(frame_width, frame_height)
+    return max(1, round(frame_width * scale)), max(1, round(frame_height * scale))
+
+
+def to_inference_rgb(image: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """
+    Writes the BGR image into dst as RGB at the size of dst, resizing first so the colour conversion only touches the
+    smaller image. Landmarks are normalized to the image extent and the aspect ratio is kept, so landmarks found on dst
+    scale straight back to the full resolution frame. The resize is linear, INTER_AREA at non integer scales takes
+    longer than the inference it is meant to speed up
+    """
+    if dst.shape == image.shape:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=dst)
+
+    cv2.resize(image, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(dst, cv2.COLOR_BGR2RGB, dst=dst)
+
+
+def inference_buffer(image: np.ndarray, max_side: Optional[int] = None) -> np.ndarray:
+    """
+    Allocates the RGB buffer for inference on image sized frames
+    """
+    width, height = inference_size(image.shape[1], image.shape[0], max_side)
+    return np.empty((height, width, image.shape[2]), dtype=image.dtype)
+
+
+def serial_pose_landmarks(frames: Iterable[Tuple[int, np.ndarray]], pose_kwargs: Dict,
+                          max_side: Optional[int] = None) \
+        -> Iterator[Tuple[int, np.ndarray, Optional[NormalizedLandmarkList]]]:
+    """
+    Runs pose inference frame by frame with a single Pose instance. Frames are converted to RGB, downscaled to max_side
+    if given, into one reused buffer. Pose.process copies its input so the buffer is free again once it returns
+    Yields: frame number, full resolution BGR image and the pose landmarks (None if no pose was detected)
+    """
+    rgb_image = None
+    with mp.solutions.pose.Pose(**pose_kwargs) as pose:
+        for frame, image in frames:
+            if rgb_image is None:
+                rgb_image = inference_buffer(image, max_side)
+            yield frame, image, pose.process(to_inference_rgb(image, rgb_image)).pose_landmarks
+
+
+def pose_roi(pose_landmarks: NormalizedLandmarkList, frame_width: int, frame_height: int,
+             padding: float = roi_padding) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Returns the (x0, y0, x1, y1) pixel box to crop the next frame to: a square around the landmarks of pose_landmarks,
+    padded by padding of its side on every side and clipped to the frame. None if the box covers most of the frame
+    """
+    xy = np.array([(landmark.x, landmark.y) for landmark in pose_landmarks.landmark]) * [frame_width, frame_height]
+    center = (xy.min(axis=0) + xy.max(axis=0)) / 2
+    half_side = (xy.max(axis=0) - xy.min(axis=0)).max() * (0.5 + padding)
+
+    x0, y0 = np.clip(np.floor(center - half_side), 0, None).astype(int)
+    x1, y1 = np.minimum(np.ceil(center + half_side), [frame_width, frame_height]).astype(int)
+    if x1 <= x0 or y1 <= y0 or (x1 - x0) * (y1 - y0) > roi_max_area_fraction * frame_width * frame_height:
+        return None
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def remap_roi_landmarks(pose_landmarks: NormalizedLandmarkList, roi: Tuple[int, int, int, int],
+                        frame_width: int, frame_height: int) -> NormalizedLandmarkList:
+    """
+    Remaps landmarks normalized to the roi crop in place, to landmarks normalized to the full frame. z is on the scale
+    of x, so it is rescaled with the crop width
+    """
+    x0, y0, x1, y1 = roi
+    for landmark in pose_landmarks.landmark:
+        landmark.x = (x0 + landmark.x * (x1 - x0)) / frame_width
+        landmark.y = (y0 + landmark.y * (y1 - y0)) / frame_height
+        landmark.z = landmark.z * (x1 - x0) / frame_width
+    return pose_landmarks
+
+
+def mean_visibility(pose_landmarks: NormalizedLandmarkList) -> float:
+    return float(np.mean([landmark.visibility for landmark in pose_landmarks.landmark]))
+
+
+def roi_pose_landmarks(frames: Iterable[Tuple[int, np.ndarray]], pose_kwargs: Dict, max_side: Optional[int] = None,
+                       padding: float = roi_padding, min_visibility: float = roi_min_visibility) \
+        -> Iterator[Tuple[int, np.ndarray, Optional[NormalizedLandmarkList]]]:
+    """
+    Runs pose inference on the region of each frame around the pose of the previous frame (see pose_roi), so a small
+    subject fills more of the model input and less of the frame is converted. The full frame is searched instead when
+    there is no previous pose or the crop finds no confident pose. Each crop depends on the previous result, so this
+    always runs in a single process.
+    MediaPipe keeps its tracking and smoothing state in the normalized coordinates of its previous input, so crops and
+    full frames go to separate Pose instances. The crop instance does not smooth landmarks, the crop moves with the
+    pose every frame. Each instance is reset when it takes over from the other, its state is from an older frame
+    Yields: frame number, full resolution BGR image and the pose landmarks normalized to the full frame
+    """
+    roi = None
+    full_frame_buffer = None
+    # Instance that processed the previous frame
+    last_pose = None
+    with mp.solutions.pose.Pose(**pose_kwargs) as full_frame_pose, \
+            mp.solutions.pose.Pose(**dict(pose_kwargs, smooth_landmarks=False)) as crop_pose:
+        for frame, image in frames:
+            frame_height, frame_width = image.shape[:2]
+
+            pose_landmarks = None
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                crop = image[y0:y1, x0:x1]
+                if last_pose is not crop_pose:
+                    crop_pose.reset()
+                last_pose = crop_pose
+                # Crops change size every frame and are small, their buffer is not reused
+                pose_landmarks = crop_pose.process(to_inference_rgb(crop, inference_buffer(crop, max_side))) \
+                    .pose_landmarks
+                if pose_landmarks and mean_visibility(pose_landmarks) >= min_visibility:
+                    remap_roi_landmarks(pose_landmarks, roi, frame_width, frame_height)
+                else:
+                    pose_landmarks = None
+
+            if pose_landmarks is None:
+                if full_frame_buffer is None:
+                    full_frame_buffer = inference_buffer(image, max_side)
+                if last_pose is crop_pose:
+                    full_frame_pose.reset()
+                last_pose = full_frame_pose
+                pose_landmarks = full_frame_pose.process(to_inference_rgb(image, full_frame_buffer)).pose_landmarks
+
+            roi = pose_roi(pose_landmarks, frame_width, frame_height, padding) if pose_landmarks else None
+            yield frame, image, pose_landmarks
+
+
+def pose_displacement(previous: NormalizedLandmarkList, current: NormalizedLandmarkList,
+                      min_visibility: float = draft_min_visibility) -> float:
+    """
+    Largest x, y displacement, normalized to the frame, of the joints visible in both poses. Every joint is measured
+    if none is visible
+    """
+    joints = np.array([[(a.x, a.y, a.visibility), (b.x, b.y, b.visibility)]
+                       for a, b in zip(previous.landmark, current.landmark)])
+    displacement = np.abs(joints[:, 1, :2] - joints[:, 0, :2]).max(axis=1)
+    visible = joints[:, :, 2].min(axis=1) >= min_visibility
+    return float(displacement[visible].max() if visible.any() else displacement.max())
+
+
+def draft_pose_landmarks(frames: Iterable[Tuple[int, np.ndarray]], pose_kwargs: Dict, stride: int,
+                         motion_budget: Optional[float] = None, max_side: Optional[int] = None) \
+        -> Iterator[Tuple[int, np.ndarray, Optional[NormalizedLandmarkList], bool]]:
+    """
+    Runs pose inference on every stride-th frame only, for draft quality output. With motion_budget the stride adapts
+    to the motion between the last two inferred poses: the next frame inferred is the one the fastest visible joint
+    (see pose_displacement) is expected to reach motion_budget (fraction of the frame) away at, at most stride frames
+    ahead. Frames are inferred one by one while no pose is found, so every gap between two poses is made of skipped
+    frames only
+    Yields: frame number, BGR image, the pose landmarks and whether inference ran on the frame. Landmarks are None on
+    skipped frames
+    """
+    rgb_image = None
+    next_frame = 0
+    previous = None
+    with mp.solutions.pose.Pose(**pose_kwargs) as pose:
+        for frame, image in frames:
+            if frame < next_frame:
+                yield frame, image, None, False
+                continue
+
+            if rgb_image is None:
+                rgb_image = inference_buffer(image, max_side)
+            pose_landmarks = pose.process(to_inference_rgb(image, rgb_image)).pose_landmarks
+
+            step = stride
+            if pose_landmarks is None:
+                step = 1
+            elif motion_budget is not None:
+                # The frame after a new pose is inferred too, to measure its speed
+                step = 1
+                if previous is not None:
+                    speed = pose_displacement(previous[1], pose_landmarks) / (frame - previous[0])
+                    step = int(np.clip(motion_budget // speed, 1, stride)) if speed > 0 else stride
+            previous = (frame, pose_landmarks) if pose_landmarks else None
+            next_frame = frame + step
+
+            yield frame, image, pose_landmarks, True
+
+
+def parallel_chunk_frames(image: np.ndarray, workers: int, chunk_size: int = parallel_chunk_size,
+                          warmup_frames: int = parallel_warmup_frames) -> int:
+    """
+    Frames per chunk, chunk_size shortened so the workers + 1 chunks in flight fit in parallel_max_bytes
+    """
+    max_frames = parallel_max_bytes // ((workers + 1) * image.nbytes) - warmup_frames
+    return int(max(warmup_frames, 1, min(chunk_size, max_frames)))
+
+
+def _share_chunk(chunk: List[np.ndarray], warmup: Optional[np.ndarray],
+                 warmup_frames: int) -> Tuple[SharedMemory, Tuple[int, ...], str, Optional[np.ndarray]]:
+    """
+    Copies the warmup frames and the BGR frames of a chunk into a new shared memory block. Returns the block, its
+    shape and dtype, and a copy of the frames to replay at the start of the next chunk
+    """
+    n_warmup = 0 if warmup is None else len(warmup)
+    shape = (n_warmup + len(chunk),) + chunk[0].shape
+    block = SharedMemory(create=True, size=int(np.prod(shape)) * chunk[0].itemsize)
+    images = np.ndarray(shape, dtype=chunk[0].dtype, buffer=block.buf)
+    if n_warmup:
+        images[:n_warmup] = warmup
+    for block_image, image in zip(images[n_warmup:], chunk):
+        block_image[...] = image
+    next_warmup = images[max(n_warmup, len(images) - warmup_frames):].copy() if warmup_frames > 0 else None
+    return block, shape, images.dtype.str, next_warmup
+
+
+def _release_block(block: SharedMemory) -> None:
+    block.close()
+    block.unlink()
+
+
+def parallel_pose_landmarks(frames: Iterable[Tuple[int, np.ndarray]], pose_kwargs: Dict, workers: int,
+                            chunk_size: int = parallel_chunk_size, warmup_frames: int = parallel_warmup_frames,
+                            max_side: Optional[int] = None) \
+        -> Iterator[Tuple[int, np.ndarray, Optional[NormalizedLandmarkList]]]:
+    """
+    Shards the frame stream in chunks of chunk_size frames across a pool of worker processes, each with its own Pose
+    instance. Every chunk is prefixed with the last warmup_frames frames of the previous chunk so the tracker enters the
+    chunk with the state it would have had in a serial run. At most workers + 1 chunks are in flight, shortened to fit
+    parallel_max_bytes (see parallel_chunk_frames). The decoded frames are handed to the workers in shared memory and
+    only held there until their chunk is collected, the workers convert and downscale them to max_side if given.
+    Yields: frame number, full resolution BGR image and the pose landmarks in frame order
+    """
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return
+    chunk_size = parallel_chunk_frames(first[1], workers, chunk_size, warmup_frames)
+    frames = chain([first], frames)
+    pending: Deque[Tuple[List[int], SharedMemory, Tuple[int, ...], str, int, Future]] = deque()
+
+    # Spawned workers: the caller may be the threaded Streamlit server or have encoder threads running, forking either
+    # is not safe
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pose_kwargs,),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        try:
+            warmup = None
+            while True:
+                chunk = list(islice(frames, chunk_size))
+                if not chunk:
+                    break
+
+                n_warmup = 0 if warmup is None else len(warmup)
+                block, shape, dtype, warmup = _share_chunk([image for _, image in chunk], warmup, warmup_frames)
+                future = executor.submit(_process_chunk, block.name, shape, dtype, n_warmup, max_side)
+                pending.append(([frame for frame, _ in chunk], block, shape, dtype, n_warmup, future))
+                # The decoded frames now live in the block only
+                del chunk
+
+                while len(pending) > workers:
+                    yield from _collect_chunk(*pending.popleft())
+
+            while pending:
+                yield from _collect_chunk(*pending.popleft())
+        finally:
+            # Stopped early or failed: drop the chunks not started yet and free every block still in flight
+            while pending:
+                block, future = pending.popleft()[1::4]
+                future.cancel()
+                _release_block(block)
+
+
+def _collect_chunk(frames: List[int], block: SharedMemory, shape: Tuple[int, ...], dtype: str, warmup: int,
+                   future: Future) -> Iterator[Tuple[int, np.ndarray, Optional[NormalizedLandmarkList]]]:
+    try:
+        landmarks = future.result()
+        # Frames are copied out of the block, so it is released before they are yielded
+        images = np.ndarray(shape, dtype=dtype, buffer=block.buf)[warmup:].copy()
+    finally:
+        _release_block(block)
+    for frame, image, pose_landmarks in zip(frames, images, landmarks):
+        yield frame, image, pose_landmarks
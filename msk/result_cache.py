@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on Windows, the manifest is then only guarded within the process
+    fcntl = None
+
+result_cache_dir_name = 'xray_cache'
+manifest_file_name = 'manifest.json'
+manifest_lock_file_name = 'manifest.lock'
+
+# Artifacts stored for every processed video and their file names inside a cache entry
+cached_artifacts = {
+    'tracker': 'joint_tracker.parquet',
+    'annotated_video': 'joint_tracker.mp4',
+    'filtered_video': 'joint_tracker_filtered.mp4'
+}
+
+
+def digest_bytes(bytes_data: bytes) -> str:
+    return hashlib.sha256(bytes_data).hexdigest()
+
+
+def digest_file(file_path: str, block_size: int = 1 << 20) -> str:
+    """
+    sha256 of a file, read in blocks so large videos are not loaded in memory
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_key(video_digest: str, pipeline_params: Dict) -> str:
+    """
+    Content address of a processed video - the digest of the video bytes combined with every pipeline parameter that
+    changes the outputs
+    """
+    params = json.dumps(pipeline_params, sort_keys=True)
+    return hashlib.sha256(f"{video_digest}:{params}".encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Content addressed store of processed X-RAY outputs. Each entry is a directory named by its cache key holding the
+    cached_artifacts. A json manifest tracks size and last access of every entry, least recently used entries are evicted
+    once the cache goes over max_entries or max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = result_cache_dir_name, max_bytes: int = 5 * 1024 ** 3,
+                 max_entries: int = 200):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.manifest_path = os.path.join(cache_dir, manifest_file_name)
+        self.lock_path = os.path.join(cache_dir, manifest_lock_file_name)
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _manifest_lock(self) -> Iterator[None]:
+        """
+        Holds the manifest for a read-modify-write. The thread lock guards the sessions of this process, the file lock
+        the other processes sharing the cache (the app job queue, batch runs)
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_manifest(self, manifest: Dict[str, Dict]) -> None:
+        # Write to a temporary file and swap it in so readers never see a partial manifest
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _entry_paths(self, key: str) -> Dict[str, str]:
+        return {name: os.path.join(self.cache_dir, key, file_name) for name, file_name in cached_artifacts.items()}
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        """
+        Returns the artifact paths of a cached entry and marks it as recently used, None on a cache miss
+        """
+        with self._manifest_lock():
+            manifest = self._load_manifest()
+            if key not in manifest:
+                return None
+
+            paths = self._entry_paths(key)
+            if not all(os.path.exists(path) for path in paths.values()):
+                # Entry was partially removed from disk, drop it
+                self._remove_entry(manifest, key)
+                self._save_manifest(manifest)
+                return None
+
+            manifest[key]['last_access'] = time.time()
+            self._save_manifest(manifest)
+            return paths
+
+    def put(self, key: str, artifact_paths: Dict[str, str], source_name: str = "",
+            pipeline_params: Optional[Dict] = None) -> Dict[str, str]:
+        """
+        Moves the artifacts produced for key into the cache and evicts least recently used entries over the limits
+        :param artifact_paths: path of every artifact in cached_artifacts
+        :return: paths of the artifacts inside the cache
+        """
+        paths = self._entry_paths(key)
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        for name, path in paths.items():
+            shutil.move(artifact_paths[name], path)
+
+        with self._manifest_lock():
+            manifest = self._load_manifest()
+            now = time.time()
+            manifest[key] = {
+                'source_name': source_name,
+                'pipeline_params': pipeline_params or {},
+                'size_bytes': sum(os.path.getsize(path) for path in paths.values()),
+                'created': now,
+                'last_access': now
+            }
+            self._evict(manifest, keep=key)
+            self._save_manifest(manifest)
+
+        return paths
+
+    def _evict(self, manifest: Dict[str, Dict], keep: str) -> None:
+        by_last_access = sorted(manifest, key=lambda k: manifest[k]['last_access'])
+        total_bytes = sum(entry['size_bytes'] for entry in manifest.values())
+
+        for key in by_last_access:
+            if len(manifest) <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total_bytes -= manifest[key]['size_bytes']
+            self._remove_entry(manifest, key)
+
+    def _remove_entry(self, manifest: Dict[str, Dict], key: str) -> None:
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        manifest.pop(key, None)
@@ -0,0 +1,45 @@
+import json
+from typing import Dict, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Key of the X-RAY metadata (frame rate, resolution, pipeline settings) in the parquet schema metadata
+tracker_metadata_key = b'xray_tracker'
+
+
+def write_tracker(df: pd.DataFrame, tracker_path: str, metadata: Dict) -> None:
+    """
+    Writes a tracker dataframe to parquet with the X-RAY metadata in the schema
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[tracker_metadata_key] = json.dumps(metadata).encode()
+    pq.write_table(table.replace_schema_metadata(schema_metadata), tracker_path)
+
+
+def read_tracker_metadata(tracker_path: str) -> Dict:
+    """
+    Reads only the X-RAY metadata of a tracker file, without loading the columns
+    """
+    schema_metadata = pq.read_schema(tracker_path).metadata or {}
+    return json.loads(schema_metadata.get(tracker_metadata_key, b'{}'))
+
+
+def read_tracker(tracker_path: str) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Returns the tracker dataframe and its X-RAY metadata
+    """
+    table = pq.read_table(tracker_path)
+    metadata = json.loads((table.schema.metadata or {}).get(tracker_metadata_key, b'{}'))
+    return table.to_pandas(), metadata
+
+
+def tracker_to_csv(tracker_path: str, csv_path: str) -> str:
+    """
+    Exports a tracker file to csv on demand
+    """
+    df, _ = read_tracker(tracker_path)
+    df.to_csv(csv_path, index=False)
+    return csv_path
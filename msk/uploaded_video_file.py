@@ -1,18 +1,19 @@
 import os
-import shutil
-import subprocess
+from typing import Callable, Dict, Optional
 
-from msk.jointlandmarks import joints_list_to_csv, post_process_tracker_csv
-from msk.mks_plotter import mediapose_mks_plotter, plot_filtered_tracker_video
+import numpy as np
+
+from msk.filtering import default_filter_order, default_cutoff_hz, filter_lag_frames, filter_lag_periods
+from msk.jointlandmarks import post_process_landmarks
+from msk.mks_plotter import mediapose_mks_plotter, pose_settings, buffered_filter_lag, frame_buffer_max_bytes
+from msk.pose_pool import parallel_chunk_size, parallel_max_bytes, parallel_warmup_frames
+from msk.video_encoder import check_output_timing, encoder_settings
+from msk.result_cache import ResultCache, cache_key, digest_file
+from msk.tracker_io import write_tracker, tracker_to_csv
 
 tracker_csv_dir_name = 'tracker_csvs'
 mediapose_mks_dir_name = 'mediapose_mks'
 filtered_mks_dir_name = 'filtered_mks'
-uploaded_videos_dir_name = 'uploaded_videos'
-
-def video_converter(input_: str, output: str) -> None:
-    subprocess.run(['ffmpeg', '-y', '-i', input_, output])
-    return
 
 def get_name_from_path(file_path):
     file_name =  file_path.split(os.sep)[-1]
@@ -22,7 +23,7 @@ def get_name_from_path(file_path):
 def create_tracker_paths(file_path):
     """
     Given a file name returns a tuple of paths (if they don't exist, placeholders will be created) for
-    1. tracker_csv
+    1. tracker (parquet)
     2. annotated video
     3. filtered annotated  video
     """
@@ -41,27 +42,12 @@ def create_tracker_paths(file_path):
     if not os.path.exists(filtered_mks_dir_name):
         os.makedirs(filtered_mks_dir_name, exist_ok=True)
 
-    output_annotated_video = f"{os.path.join(mediapose_mks_dir_name, file_name)}_joint_tracker.avi"
-    output_tracker_file = f"{os.path.join(tracker_csv_dir_name, file_name)}_joint_tracker.csv"
-    output_filt_video = f"{os.path.join(filtered_mks_dir_name, file_name)}_joint_tracker_filtered.avi"
+    output_annotated_video = f"{os.path.join(mediapose_mks_dir_name, file_name)}_joint_tracker.mp4"
+    output_tracker_file = f"{os.path.join(tracker_csv_dir_name, file_name)}_joint_tracker.parquet"
+    output_filt_video = f"{os.path.join(filtered_mks_dir_name, file_name)}_joint_tracker_filtered.mp4"
 
     return output_tracker_file, output_annotated_video, output_filt_video
 
-def upload_video(bytes_data: bytes, file_path: str) -> None:
-    # Delete everything in file_path before uploading the video
-    try:
-        shutil.rmtree(uploaded_videos_dir_name)
-    except FileNotFoundError:
-        pass
-
-    # Create a place holder for videos uploaded
-    if not os.path.exists(uploaded_videos_dir_name):
-        os.makedirs(uploaded_videos_dir_name, exist_ok=True)
-
-    with open(file_path, 'wb') as f:
-        f.write(bytes_data)
-
-
 def get_video_bytes(video_path: str):
     """
     Shows video on the streamlit page
@@ -71,54 +57,150 @@ def get_video_bytes(video_path: str):
         return bytes
 
 
-def video_exists(filtered_video_path) -> bool:
-    return os.path.exists(filtered_video_path)
-
 class UploadedFile:
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, inference_workers: int = 1, result_cache: Optional[ResultCache] = None,
+                 cutoff_hz: float = default_cutoff_hz, filter_strategy: str = 'low_pass', reject_outliers: bool = True,
+                 inference_max_side: Optional[int] = None, roi_tracking: bool = False, draft_stride: int = 1,
+                 draft_motion_budget: Optional[float] = None, output_fps: Optional[float] = None,
+                 slow_motion: float = 1.0):
+        check_output_timing(output_fps, slow_motion)
 
         self.file_path = file_path
+        # Low pass filter cutoff in Hz, applied at the frame rate of the video
+        self.cutoff_hz = cutoff_hz
+        # Filter of the tracker signals, one of filter_strategies. The filtered overlay is always low pass filtered as
+        # it is drawn from a bounded window of frames while the video is decoded
+        self.filter_strategy = filter_strategy
+        # Replace jumps in the tracked joints before filtering
+        self.reject_outliers = reject_outliers
+        # Number of processes running pose inference, 1 keeps inference in this process
+        self.inference_workers = inference_workers
+        # Longest side of the frames pose inference runs on, None for full resolution. default_inference_max_side is the
+        # suggested value, the overlays are drawn at full resolution either way
+        self.inference_max_side = inference_max_side
+        # Infer on a crop around the previous pose, for subjects that fill a small part of the frame
+        self.roi_tracking = roi_tracking
+        # Draft mode, inference on every draft_stride-th frame or adaptively to the motion when draft_motion_budget is
+        # set (see draft_pose_landmarks), the joints in between are interpolated
+        self.draft_stride = draft_stride
+        self.draft_motion_budget = draft_motion_budget
+        # Overlay videos keep the source frame rate, output_fps drops frames to a lower rate and slow_motion > 1 slows
+        # their playback down
+        self.output_fps = output_fps
+        self.slow_motion = slow_motion
+        # Processed outputs are looked up by video content in result_cache before running the pipeline
+        self.result_cache = result_cache
 
         # Create tracker paths
         self.tracker_path, self.annotated_video_path, self.filt_video_path = create_tracker_paths(file_path)
 
 
-    def process_video(self) -> str:
+    def pipeline_params(self) -> Dict:
         """
-        1. Generate MKS overlay for the video
-        2. Output a tracker list csv
-        3. Create a filtered video output
+        Parameters that change the processed outputs, part of the result cache key
+        """
+        return {
+            'model_complexity': pose_settings['model_complexity'],
+            'min_detection_confidence': pose_settings['min_detection_confidence'],
+            'min_tracking_confidence': pose_settings['min_tracking_confidence'],
+            # Chunks start from a reset tracker seeded with a few replayed frames, close to but not the same as a
+            # serial run
+            'inference_workers': self.inference_workers,
+            'parallel_chunk_size': parallel_chunk_size,
+            'parallel_warmup_frames': parallel_warmup_frames,
+            'parallel_max_bytes': parallel_max_bytes,
+            'inference_max_side': self.inference_max_side,
+            'roi_tracking': self.roi_tracking,
+            'draft_stride': self.draft_stride,
+            'draft_motion_budget': self.draft_motion_budget,
+            'filter_strategy': self.filter_strategy,
+            'reject_outliers': self.reject_outliers,
+            'filter_order': default_filter_order,
+            'filter_cutoff_hz': self.cutoff_hz,
+            'filter_lag_periods': filter_lag_periods,
+            'frame_buffer_max_bytes': frame_buffer_max_bytes,
+            'video_encoder': encoder_settings(),
+            'output_fps': self.output_fps,
+            'slow_motion': self.slow_motion,
+            'tracker_format': 'parquet',
+            # One tracker row per video frame, NaN rows for the frames without a pose
+            'tracker_rows': 'all_frames'
+        }
+
+    def process_video(self, preview: Optional[Callable[[int, np.ndarray], None]] = None) -> str:
+        """
+        Returns the filtered video path, from the result cache if this video was processed with the same pipeline
+        parameters before. preview receives live preview frames while the video is processed, see mediapose_mks_plotter
+        """
+        if self.result_cache is None:
+            return self.run_pipeline(preview)
+
+        key = cache_key(digest_file(self.file_path), self.pipeline_params())
+        cached_paths = self.result_cache.get(key)
+        if cached_paths is not None:
+            print(f"Result cache hit for {self.file_path} - {key}")
+        else:
+            self.run_pipeline(preview)
+            cached_paths = self.result_cache.put(key, {
+                'tracker': self.tracker_path,
+                'annotated_video': self.annotated_video_path,
+                'filtered_video': self.filt_video_path
+            }, source_name=get_name_from_path(self.file_path), pipeline_params=self.pipeline_params())
+
+        self.tracker_path = cached_paths['tracker']
+        self.annotated_video_path = cached_paths['annotated_video']
+        self.filt_video_path = cached_paths['filtered_video']
+
+        return self.filt_video_path
+
+    def run_pipeline(self, preview: Optional[Callable[[int, np.ndarray], None]] = None) -> str:
+        """
+        1. Generate MKS overlay and filtered MKS overlay for the video in a single decode pass
+        2. Post process the joint tracker
+        3. Output the tracker with the filtered signals
         """
 
-        # 1. Generate MKS overlay for the video
-        joint_tracker_list, img_width, img_height = mediapose_mks_plotter(self.file_path, self.annotated_video_path)
-
-        # 2. Output a tracker list csv
-        joints_list_to_csv(joint_tracker_list, self.tracker_path)
-        print(f"Tracker csv created - {self.tracker_path}")
-
-        # Post processing the joint tracker
-        print("Post processing the video")
-        # Post process tracker csv
-        df_to_plot = post_process_tracker_csv(self.tracker_path, img_height)
-        df_to_plot.to_csv(self.tracker_path, index=False)
-        print(f"Tracker csv updated with filtered signals - {self.tracker_path}")
-
-        # 3. Create a filtered video output
-        # MKS plotter with filtered signals
-        plot_filtered_tracker_video(self.file_path, self.filt_video_path, df_to_plot)
-
+        # 1. Generate MKS overlay and filtered MKS overlay for the video
+        landmark_store, img_width, img_height = mediapose_mks_plotter(self.file_path, self.annotated_video_path,
+                                                                      self.filt_video_path,
+                                                                      cutoff_hz=self.cutoff_hz,
+                                                                      reject_outliers=self.reject_outliers,
+                                                                      inference_workers=self.inference_workers,
+                                                                      inference_max_side=self.inference_max_side,
+                                                                      roi_tracking=self.roi_tracking,
+                                                                      draft_stride=self.draft_stride,
+                                                                      draft_motion_budget=self.draft_motion_budget,
+                                                                      output_fps=self.output_fps,
+                                                                      slow_motion=self.slow_motion,
+                                                                      preview=preview)
         print("Filtered MKS video created")
 
-        # Convert annotated video to mp4
-        print(f"Converting {self.annotated_video_path} to mp4")
-        annotated_video_mp4 = self.annotated_video_path.split('.')[0] + '.mp4'
-        video_converter(self.annotated_video_path, annotated_video_mp4)
-
-        # Convert the filtered video to mp4
-        print(f"Converting {self.filt_video_path} to mp4")
-        mp4_filtered_file_name = self.filt_video_path.split('.')[0] + '.mp4'
-        video_converter(self.filt_video_path, mp4_filtered_file_name)
-
-        return mp4_filtered_file_name
+        # 2. Post process the joint tracker straight from the landmark store
+        print("Post processing the video")
+        df_to_plot = post_process_landmarks(landmark_store, img_height, self.cutoff_hz,
+                                            self.filter_strategy, self.reject_outliers)
+
+        # 3. Output the tracker with the filtered signals
+        write_tracker(df_to_plot, self.tracker_path, {
+            'fps': landmark_store.fps,
+            'width': img_width,
+            'height': img_height,
+            'frames': len(landmark_store),
+            'detected_frames': int((landmark_store.present & ~landmark_store.interpolated).sum()),
+            'interpolated_frames': int(landmark_store.interpolated.sum()),
+            # Look-ahead of the filtered overlay drawn in the decode pass, None when it was drawn from the whole clip
+            # in a second pass because the filter window did not fit in the frame buffer
+            'filtered_overlay_lag': buffered_filter_lag(filter_lag_frames(landmark_store.fps, self.cutoff_hz),
+                                                        self.draft_stride, img_width, img_height),
+            'pipeline_params': self.pipeline_params()
+        })
+        print(f"Tracker created with filtered signals - {self.tracker_path}")
+
+        return self.filt_video_path
+
+    def export_tracker_csv(self) -> str:
+        """
+        Writes the tracker as csv next to the parquet tracker and returns the csv path
+        """
+        return tracker_to_csv(self.tracker_path, os.path.splitext(self.tracker_path)[0] + '.csv')
@@ -0,0 +1,191 @@
+import queue
+import shutil
+import subprocess
+import threading
+from typing import List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+# Preferred OpenCV mp4 codecs in order, used when ffmpeg is not installed
+mp4_codecs = ('avc1', 'mp4v')
+
+# libx264 settings of the ffmpeg encoder: veryfast keeps up with inference, crf 23 is the x264 default quality
+h264_preset = 'veryfast'
+h264_crf = 23
+
+# Frames waiting to be piped to ffmpeg, per output
+encoder_queue_frames = 8
+
+# Frame rate written when the source does not report one
+default_video_fps = 30.0
+
+
+def ffmpeg_path() -> Optional[str]:
+    return shutil.which('ffmpeg')
+
+
+def encoder_settings() -> dict:
+    """
+    Encoder used for the overlay videos and its settings, part of the result cache key
+    """
+    if ffmpeg_path() is not None:
+        return {'encoder': 'ffmpeg-libx264', 'preset': h264_preset, 'crf': h264_crf}
+    return {'encoder': 'opencv', 'codecs': list(mp4_codecs)}
+
+
+def check_output_timing(output_fps: Optional[float] = None, slow_motion: float = 1.0) -> None:
+    """
+    Raises ValueError unless output_fps, when given, and slow_motion are positive
+    """
+    if output_fps is not None and not output_fps > 0:
+        raise ValueError(f"output_fps must be positive, got {output_fps}")
+    if not slow_motion > 0:
+        raise ValueError(f"slow_motion must be positive, got {slow_motion}")
+
+
+def output_timing(source_fps: float, output_fps: Optional[float] = None, slow_motion: float = 1.0) -> Tuple[int, float]:
+    """
+    Frame stride and frame rate of an overlay video. Videos keep the source frame rate and real time playback by
+    default. With output_fps below the source frame rate, only every stride-th source frame is written (decimation).
+    slow_motion > 1 plays the written frames that many times slower than real time
+    :return: stride between written source frames and the frame rate to write them at
+    """
+    check_output_timing(output_fps, slow_motion)
+    if not source_fps or source_fps <= 0:
+        source_fps = default_video_fps
+
+    stride = 1
+    if output_fps is not None and output_fps < source_fps:
+        stride = max(1, round(source_fps / output_fps))
+    return stride, source_fps / stride / slow_motion
+
+
+def open_mp4_writer(video_path: str, fps: float, frame_size: Tuple[int, int]) -> cv2.VideoWriter:
+    """
+    Returns an OpenCV video writer for an mp4 output. H.264 is preferred so the file plays in the browser, MPEG-4 is
+    the fallback for OpenCV builds without an H.264 encoder
+    """
+    for codec in mp4_codecs:
+        out = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*codec), fps, frame_size)
+        if out.isOpened():
+            return out
+        out.release()
+
+    raise IOError(f"Cannot open an mp4 writer for {video_path}")
+
+
+class FfmpegWriter:
+    """
+    Encodes BGR frames to a browser playable H.264 mp4 by piping them raw to one long lived ffmpeg process. Frames are
+    copied into a small pool of buffers and piped from a background thread, so the caller can reuse its frame right
+    away and every output encodes in its own ffmpeg process alongside the decode and inference loop.
+    Same write / release interface as cv2.VideoWriter.
+    """
+
+    def __init__(self, video_path: str, fps: float, frame_size: Tuple[int, int], preset: str = h264_preset,
+                 crf: int = h264_crf, queue_frames: int = encoder_queue_frames):
+        self.video_path = video_path
+        self.frame_size = frame_size
+        width, height = frame_size
+
+        self._process = subprocess.Popen(self.ffmpeg_command(video_path, fps, frame_size, preset, crf),
+                                         stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        self._free: queue.Queue = queue.Queue()
+        for _ in range(queue_frames):
+            self._free.put(np.empty((height, width, 3), dtype=np.uint8))
+        self._pending: queue.Queue = queue.Queue()
+        self._error: Optional[Exception] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._pipe_frames, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def ffmpeg_command(video_path: str, fps: float, frame_size: Tuple[int, int], preset: str, crf: int) -> List[str]:
+        return [ffmpeg_path(), '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{frame_size[0]}x{frame_size[1]}", '-r', str(fps),
+                '-i', '-',
+                '-an', '-c:v', 'libx264', '-preset', preset, '-crf', str(crf),
+                # yuv420p (even frame sizes) and the index at the start of the file for browser playback
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '-movflags', '+faststart',
+                video_path]
+
+    def _pipe_frames(self) -> None:
+        while True:
+            buffer = self._pending.get()
+            if buffer is None:
+                break
+            try:
+                if self._error is None:
+                    self._process.stdin.write(buffer.data)
+            except (BrokenPipeError, OSError) as e:
+                self._error = e
+            self._free.put(buffer)
+
+    def isOpened(self) -> bool:
+        return self._process.poll() is None and self._error is None
+
+    def write(self, image: np.ndarray) -> None:
+        if self._error is not None:
+            raise IOError(f"ffmpeg stopped encoding {self.video_path}: {self._error}")
+        buffer = self._free.get()
+        np.copyto(buffer, image)
+        self._pending.put(buffer)
+
+    def release(self) -> None:
+        """
+        Waits for the queued frames and for ffmpeg to finish the file
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._pending.put(None)
+        self._thread.join()
+        self._process.stdin.close()
+        stderr = self._process.stderr.read().decode(errors='replace')
+        self._process.stderr.close()
+        if self._process.wait() != 0 or self._error is not None:
+            raise IOError(f"ffmpeg failed to encode {self.video_path}: {stderr.strip() or self._error}")
+
+    def close(self) -> None:
+        """
+        Aborts the encoding: kills ffmpeg and stops the pipe thread without finishing the file. Used on errors, so
+        no ffmpeg process is left waiting on its input
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._process.kill()
+        # Writes to the killed process fail, the thread drops the queued frames and exits
+        self._pending.put(None)
+        self._thread.join()
+        for pipe in (self._process.stdin, self._process.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self._process.wait()
+
+
+# Writers returned by open_video_writer
+VideoWriter = Union[FfmpegWriter, cv2.VideoWriter]
+
+
+def open_video_writer(video_path: str, fps: float, frame_size: Tuple[int, int]) -> VideoWriter:
+    """
+    Returns the writer of an overlay video: H.264 through ffmpeg when it is installed, OpenCV otherwise
+    """
+    if ffmpeg_path() is not None:
+        return FfmpegWriter(video_path, fps, frame_size)
+    return open_mp4_writer(video_path, fps, frame_size)
+
+
+def close_video_writer(writer: VideoWriter) -> None:
+    """
+    Closes a writer without finishing its file after an error, see FfmpegWriter.close
+    """
+    if isinstance(writer, FfmpegWriter):
+        writer.close()
+    else:
+        writer.release()
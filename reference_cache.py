@@ -0,0 +1,108 @@
+import copy
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+# Seconds a reference lookup (trainers, facilities, teams, ...) is served from memory before it is fetched again.
+# Edits made through this app invalidate the affected lookups right away, the TTL only bounds how long edits made
+# elsewhere take to show up
+REFERENCE_TTL_S = 300
+
+# Lookups kept in memory, one per kind and database. The least recently used one is dropped beyond that
+REFERENCE_MAX_ENTRIES = 64
+
+
+class ReferenceCache:
+    """
+    Thread safe in-memory cache of reference data lookups keyed by (kind, db_name), with a TTL and a size bound.
+    One cache is shared by every Streamlit session of the app process
+    """
+
+    def __init__(self, ttl_s: float = REFERENCE_TTL_S, max_entries: int = REFERENCE_MAX_ENTRIES):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]" = OrderedDict()
+        # Bumped by every invalidation, lets holders of derived data (DB_setup) tell that it is out of date
+        self._generation = 0
+        self._versions: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, db_name: Hashable) -> Optional[Any]:
+        """
+        Returns the cached value or None when it is missing or expired
+        """
+        key = (kind, db_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored, value = entry
+            if time.monotonic() - stored > self.ttl_s:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, kind: str, db_name: Hashable, value: Any) -> None:
+        key = (kind, db_name)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, db_name: Optional[Hashable] = None, *kinds: str) -> None:
+        """
+        Drops the lookups of kinds for db_name. No kinds drops every lookup of db_name, no db_name drops everything
+        """
+        with self._lock:
+            if db_name is None:
+                self._generation += 1
+            else:
+                self._versions[db_name] = self._versions.get(db_name, 0) + 1
+            for kind, name in list(self._entries):
+                if (db_name is None or name == db_name) and (not kinds or kind in kinds):
+                    del self._entries[(kind, name)]
+
+    def version(self, db_name: Hashable) -> Tuple[int, int]:
+        """
+        Changes whenever lookups of db_name are invalidated
+        """
+        with self._lock:
+            return self._generation, self._versions.get(db_name, 0)
+
+
+reference_cache = ReferenceCache()
+
+
+def cached_reference(kind: str) -> Callable:
+    """
+    Decorates a lookup function taking db_name, so its result is served from reference_cache. Callers get their own
+    copy and cannot alter the cached value
+    :param kind: name of the lookup, used by invalidate_reference_data
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(db_name: str):
+            value = reference_cache.get(kind, db_name)
+            if value is None:
+                value = func(db_name)
+                reference_cache.put(kind, db_name, value)
+            return copy.copy(value)
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate_reference_data(db_name: Optional[str] = None, *kinds: str) -> None:
+    """
+    Forgets the cached lookups of kinds for db_name, so they are fetched again on next use
+    """
+    reference_cache.invalidate(db_name, *kinds)
+
+
+def reference_version(db_name: str) -> Tuple[int, int]:
+    return reference_cache.version(db_name)
@@ -0,0 +1,127 @@
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from api_client import api_request
+
+# Rows returned per search page
+SEARCH_PAGE_SIZE = 200
+
+# Seconds a downloaded table snapshot answers searches before it is checked against the API again
+TABLE_SNAPSHOT_TTL_S = 60
+
+
+class TableSnapshot:
+    """
+    Local copy of a whole API table, for endpoints that do not filter server side. Rows are indexed by the lowercase
+    value of the searched column, so a search is a dictionary lookup instead of a scan of the table
+    """
+
+    def __init__(self, rows: list, etag: Optional[str]):
+        self.df = pd.DataFrame.from_records(rows)
+        self.etag = etag
+        self.fetched = time.monotonic()
+        self.stale = False
+        self._indexes: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def is_fresh(self) -> bool:
+        return not self.stale and time.monotonic() - self.fetched < TABLE_SNAPSHOT_TTL_S
+
+    def renew(self) -> None:
+        # The API reported the table unchanged
+        self.fetched = time.monotonic()
+        self.stale = False
+
+    def search(self, column: str, search_string: str) -> pd.DataFrame:
+        if column not in self.df:
+            return self.df.iloc[0:0]
+        if column not in self._indexes:
+            self._indexes[column] = self.df.groupby(self.df[column].astype(str).str.lower(), sort=False).indices
+        return self.df.iloc[self._indexes[column].get(search_string.lower(), [])]
+
+
+# Table snapshots by API path
+_snapshots: Dict[str, TableSnapshot] = {}
+# API paths known to ignore the search parameters
+_no_server_search = set()
+_lock = threading.Lock()
+
+
+def search_params(column: str, search_string: str, page: int, page_size: int) -> Dict[str, object]:
+    """
+    Query parameters of a server side search: case insensitive exact match of search_string on column, paged
+    """
+    return {'search': search_string, 'search_column': column, 'limit': page_size, 'offset': page * page_size}
+
+
+def matches(df: pd.DataFrame, column: str, search_string: str) -> bool:
+    return column in df and bool((df[column].astype(str).str.lower() == search_string.lower()).all())
+
+
+def page_rows(df: pd.DataFrame, column: str, page: int, page_size: int) -> pd.DataFrame:
+    if df.empty:
+        return df
+    return df.sort_values([column]).dropna(axis=0, how='all').iloc[page * page_size:(page + 1) * page_size]
+
+
+def fetch_snapshot(path: str) -> TableSnapshot:
+    """
+    Snapshot of the table at path. A snapshot past its TTL is revalidated with its ETag, the table is downloaded again
+    only if it changed
+    """
+    with _lock:
+        snapshot = _snapshots.get(path)
+    if snapshot is not None and snapshot.is_fresh():
+        return snapshot
+
+    headers = {'If-None-Match': snapshot.etag} if snapshot is not None and snapshot.etag else {}
+    response = api_request("GET", path, headers=headers)
+    if response.status_code == 304:
+        snapshot.renew()
+        return snapshot
+
+    snapshot = TableSnapshot(response.json(), response.headers.get('ETag'))
+    with _lock:
+        _snapshots[path] = snapshot
+    return snapshot
+
+
+def search_table(path: str, column: str, search_string: str, page: int = 0,
+                 page_size: int = SEARCH_PAGE_SIZE) -> pd.DataFrame:
+    """
+    Rows of the table at path whose column matches search_string (case insensitive), sorted by column, one page at a
+    time. The search is sent to the API so only the matching rows are downloaded. Endpoints that ignore the search
+    parameters answer with the whole table, which then becomes a local snapshot searched in memory
+    :param path: API path of the table
+    :param column: searched and sort column
+    :param search_string:
+    :param page: zero based page number
+    :param page_size:
+    :return:
+    """
+    if path not in _no_server_search:
+        response = api_request("GET", path, params=search_params(column, search_string, page, page_size))
+        rows = response.json()
+        df = pd.DataFrame.from_records(rows)
+        if df.empty or (len(df) <= page_size and matches(df, column, search_string)):
+            return page_rows(df, column, 0, page_size)
+
+        # The whole table came back, the endpoint does not search
+        with _lock:
+            _no_server_search.add(path)
+            _snapshots[path] = TableSnapshot(rows, response.headers.get('ETag'))
+
+    return page_rows(fetch_snapshot(path).search(column, search_string), column, page, page_size)
+
+
+def invalidate_table(path: str) -> None:
+    """
+    Marks the snapshot of the table at path out of date after an edit, the next search revalidates it
+    """
+    with _lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is not None:
+            snapshot.stale = True
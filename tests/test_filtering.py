@@ -0,0 +1,76 @@
+"""
+Outlier rejection on tracker signals. Run with: python -m pytest tests
+"""
+import unittest
+
+import numpy as np
+from scipy.special import erf
+
+from msk.filtering import filter_signals, outlier_mask
+
+WHIP_S = 1.5
+
+
+def pitching_clip(fps: float, seed: int = 0) -> np.ndarray:
+    """
+    3 s of joint signals with 1 to 4 px of jitter and a 0.2 s arm whip at WHIP_S: sweeps across the frame and out and
+    back movements of 300 to 900 px
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(3 * fps)) / fps - WHIP_S
+    signals = []
+    for amplitude in (300, 500, 900):
+        signals.append(200 + amplitude * (1 + erf(t / 0.05)) / 2)
+        signals.append(600 - amplitude * np.exp(-(t / 0.05) ** 2))
+        signals.append(600 - amplitude * np.exp(-(t / 0.025) ** 2))
+    jitter = rng.normal(size=(len(t), len(signals))) * rng.uniform(1, 4, len(signals))
+    return np.column_stack(signals) + jitter
+
+
+class OutlierMaskTest(unittest.TestCase):
+
+    def test_fast_smooth_motion_is_kept(self) -> None:
+        for fps in (60, 120, 240):
+            x = pitching_clip(fps)
+
+            self.assertFalse(outlier_mask(x).any(), f"{fps} fps")
+            np.testing.assert_array_equal(filter_signals(x, fps), filter_signals(x, fps, reject_outliers=False))
+
+    def test_spikes_are_flagged(self) -> None:
+        for fps in (60, 120, 240):
+            x = pitching_clip(fps)
+            # Spikes on a still joint, on a slow joint and just before the whip
+            spikes = [(int(0.5 * fps), 0, 60), (int(2.5 * fps), 1, -60), (int((WHIP_S - 0.2) * fps), 2, 60)]
+            for frame, signal, jump in spikes:
+                x[frame, signal] += jump
+
+            expected = np.zeros(x.shape, dtype=bool)
+            for frame, signal, _ in spikes:
+                expected[frame, signal] = True
+            np.testing.assert_array_equal(outlier_mask(x), expected, err_msg=f"{fps} fps")
+
+    def test_interpolated_frames(self) -> None:
+        # Draft mode at stride 8: the frames between inferences are interpolated, their float32 round-off is not a jump
+        rng = np.random.default_rng(0)
+        frames = np.arange(0, 961, 8)
+        inferred = (960 + 300 * np.sin(frames / 40)[:, np.newaxis] + rng.normal(0, 1, (len(frames), 6)))
+        x = np.column_stack([np.interp(np.arange(961), frames, column) for column in inferred.T]).astype(np.float32)
+        interpolated = np.ones(len(x), dtype=bool)
+        interpolated[frames] = False
+
+        self.assertFalse(outlier_mask(x.astype(float), interpolated=interpolated).any())
+
+        x[400, 3] += 60
+        self.assertTrue(outlier_mask(x.astype(float), interpolated=interpolated)[400, 3])
+
+    def test_missing_joints(self) -> None:
+        x = pitching_clip(60)
+        x[:, 0] = np.nan
+        x[20:40, 1] = np.nan
+
+        self.assertFalse(outlier_mask(x).any())
+        self.assertFalse(outlier_mask(x[:4]).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
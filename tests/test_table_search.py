@@ -0,0 +1,153 @@
+"""
+table_search against a local stand-in of the DVS API. Run with: python -m pytest tests
+"""
+import json
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import api_client
+import table_search
+
+try:
+    import api_calls
+except ImportError:
+    # api_calls needs the app dependencies (streamlit-aggrid)
+    api_calls = None
+
+TABLE_PATH = 'dvs_client_table/dvs_dev'
+
+
+class StandInAPI(BaseHTTPRequestHandler):
+    """
+    Serves one client table. With server_search, the search and paging parameters are applied, otherwise they are
+    ignored like the current API does. Full table responses carry an ETag and answer 304 to a matching If-None-Match
+    """
+    protocol_version = 'HTTP/1.1'
+    rows = []
+    server_search = False
+    requests = []
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body=None, etag: str = None) -> None:
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        etag = f'"{len(self.rows)}"'
+
+        if self.server_search and 'search' in query:
+            column, search = query['search_column'][0], query['search'][0].lower()
+            offset, limit = int(query['offset'][0]), int(query['limit'][0])
+            matches = [row for row in self.rows if row[column].lower() == search]
+            self.requests.append(('search', url.path))
+            return self.send_json(200, matches[offset:offset + limit])
+
+        if self.headers.get('If-None-Match') == etag:
+            self.requests.append(('not_modified', url.path))
+            return self.send_json(304, etag=etag)
+
+        self.requests.append(('full', url.path))
+        self.send_json(200, self.rows, etag)
+
+    def do_POST(self) -> None:
+        # insert_into_dvs_client/{client_id}/{db_name}
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        client_id = int(urlparse(self.path).path.split('/')[2])
+        self.rows.append(dict(payload, dvs_client_id=client_id))
+        self.requests.append(('insert', urlparse(self.path).path))
+        self.send_json(200, 1)
+
+
+class TableSearchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInAPI)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = api_client.API_BASE_URL
+        api_client.API_BASE_URL = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        api_client.API_BASE_URL = cls.base_url
+
+    def setUp(self) -> None:
+        StandInAPI.rows = [{'dvs_client_id': i, 'client_lastname': last_name}
+                           for i, last_name in enumerate(['Smith', 'Jones', 'smith', 'Brown'] * 100)]
+        StandInAPI.server_search = False
+        StandInAPI.requests = []
+        table_search._snapshots.clear()
+        table_search._no_server_search.clear()
+
+    def search(self, search_string: str, page: int = 0, page_size: int = 50):
+        return table_search.search_table(TABLE_PATH, 'client_lastname', search_string, page, page_size)
+
+    def test_server_side_search(self) -> None:
+        StandInAPI.server_search = True
+
+        first_page = self.search('SMITH')
+        second_page = self.search('smith', page=1)
+
+        self.assertEqual(len(first_page), 50)
+        self.assertTrue((first_page['client_lastname'].str.lower() == 'smith').all())
+        self.assertTrue(set(first_page['dvs_client_id']).isdisjoint(second_page['dvs_client_id']))
+        self.assertEqual(StandInAPI.requests, [('search', '/' + TABLE_PATH)] * 2)
+        self.assertNotIn(TABLE_PATH, table_search._no_server_search)
+
+    def test_snapshot_when_the_server_ignores_the_search(self) -> None:
+        jones = self.search('jones')
+        self.search('brown')
+        last_page = self.search('jones', page=1)
+
+        self.assertEqual(len(jones), 50)
+        self.assertTrue((jones['client_lastname'] == 'Jones').all())
+        self.assertEqual(len(last_page), 50)
+        self.assertTrue(self.search('nobody').empty)
+        # The whole table is downloaded once, the other searches are answered from the snapshot
+        self.assertEqual(StandInAPI.requests, [('full', '/' + TABLE_PATH)])
+
+    def test_snapshot_revalidation(self) -> None:
+        self.search('jones')
+        table_search._snapshots[TABLE_PATH].fetched -= table_search.TABLE_SNAPSHOT_TTL_S
+
+        self.assertEqual(len(self.search('jones')), 50)
+        self.assertEqual(StandInAPI.requests[-1], ('not_modified', '/' + TABLE_PATH))
+
+    def test_invalidate_table_after_insert(self) -> None:
+        self.assertEqual(len(self.search('Taylor')), 0)
+
+        StandInAPI.rows.append({'dvs_client_id': 400, 'client_lastname': 'Taylor'})
+        # Still answered from the snapshot until the table is invalidated
+        self.assertEqual(len(self.search('Taylor')), 0)
+        table_search.invalidate_table(TABLE_PATH)
+
+        self.assertEqual(self.search('taylor')['dvs_client_id'].tolist(), [400])
+        self.assertEqual(StandInAPI.requests[-1], ('full', '/' + TABLE_PATH))
+
+    @unittest.skipIf(api_calls is None, "api_calls dependencies are not installed")
+    def test_insert_refreshes_the_client_search(self) -> None:
+        self.assertTrue(api_calls.get_table(TABLE_PATH, 'Taylor', 'client_lastname').empty)
+
+        payload = types.SimpleNamespace(client_lastname='Taylor')
+        self.assertEqual(api_calls.add_player_to_db('dvs_dev', 400, payload), 200)
+
+        self.assertEqual(api_calls.get_table(TABLE_PATH, 'taylor', 'client_lastname')['dvs_client_id'].tolist(), [400])
+
+
+if __name__ == '__main__':
+    unittest.main()